@@ -1,3 +1,8 @@
+import os
+import socket
+import threading
+import time
+
 from app.errors import ObjectDoesNotExist, MultipleObjectsFound
 
 
@@ -7,3 +12,25 @@ def one(l):
     elif len(l) > 1:
         raise MultipleObjectsFound()
     return l[0]
+
+
+def get_owner():
+    # identifies this process when it holds a lease
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+class RateLimit:
+    # hands out time slots, so all threads together stay below amount_per_second, 0 for no limit
+    def __init__(self, amount_per_second):
+        self._amount_per_second = amount_per_second
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def consume(self, amount):
+        if not self._amount_per_second:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._next, now)
+            self._next = start + amount / self._amount_per_second
+        time.sleep(start - now)
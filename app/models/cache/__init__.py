@@ -1,17 +1,24 @@
 import os
+import threading
+import time
 import uuid
+from contextlib import contextmanager
 
 from Crypto.Hash import SHA3_256
 
+from app.models.cache.backend import FileBackend, MemoryBackend
 from app.models.error import RemoteStorageError, HashError
 from nimbus import config
 from nimbus.client import Client
 from nimbus.errors import ConnectionTimeoutError
 
 LOCAL_CACHE = 'cache'
+MEMORY_CACHE_MAX_SIZE = 1024 * 1024  # objects up to 1 MB are kept in memory
 STORAGE_TIMEOUT = int(config.get('control', 'seconds_before_storage_timeout'))
 CONNECT_URL = 'tcp://{}:{}'.format(config.get('storage-requests', 'client_hostname'),
                                    config.get('storage-requests', 'client_port'))
+CLIENT_POOL_SIZE = int(config.get('transfer', 'client_pool_size'))
+CLIENT_MAX_AGE = int(config.get('transfer', 'client_max_age'))
 
 os.makedirs(LOCAL_CACHE, exist_ok=True)
 
@@ -20,50 +27,116 @@ def get_client():
     return Client(connect=CONNECT_URL, timeout=STORAGE_TIMEOUT)
 
 
+class ClientPool:
+    def __init__(self, size, max_age):
+        self._max_age = max_age
+        self._available = threading.BoundedSemaphore(size)  # limits the number of clients in use
+        self._lock = threading.Lock()
+        self._idle = []  # (client, timestamp created)
+
+    def _acquire(self):
+        expired = []
+        with self._lock:
+            while self._idle:
+                client, created = self._idle.pop()
+                if time.monotonic() - created < self._max_age:
+                    break
+                expired.append(client)
+            else:
+                client, created = None, None
+        # closing can take a while, so it is done outside of the lock
+        for expired_client in expired:
+            expired_client.close()
+        if client is None:
+            return get_client(), time.monotonic()
+        return client, created
+
+    def _release(self, client, created):
+        with self._lock:
+            self._idle.append((client, created))
+
+    @contextmanager
+    def client(self):
+        self._available.acquire()
+        try:
+            client, created = self._acquire()
+            try:
+                yield client
+            except BaseException:
+                # the request failed: the state of the connection is unknown, so don't reuse it
+                client.close()
+                raise
+            self._release(client, created)
+        finally:
+            self._available.release()
+
+
+client_pool = ClientPool(CLIENT_POOL_SIZE, CLIENT_MAX_AGE)
+
+
 class CachedObject:
-    def __init__(self, expected_hash=None, file_path=None):
+    def __init__(self, expected_hash=None, file_path=None, backend=None):
         self._expected_hash = expected_hash  # to detect if contents are the same as previously uploaded
         self._initial_hash = None  # to detect if new contents are the same as initial contents
         self._is_changed = False  # to detect if there is new content
+        self._hasher = None  # hash of the current content, updated while writing
 
         if file_path is not None:
             self._file_path = file_path
         else:
             self._file_path = os.path.join(LOCAL_CACHE, uuid.uuid4().hex)
 
+        if backend is not None:
+            self._backend = backend
+        elif file_path is not None:
+            self._backend = FileBackend(self._file_path)
+        else:
+            self._backend = MemoryBackend(self._file_path, MEMORY_CACHE_MAX_SIZE)
+
     # PROPERTIES
     @property
     def hash(self):
         self._download_content()
-        chunk_size = 1024 * 1024  # 1 MB
-        hasher = SHA3_256.new()
-        with self._open('rb') as f:
-            while True:
-                chunk = f.read(chunk_size)
-                if chunk:
-                    hasher.update(chunk)
-                else:
-                    break
-        return hasher.hexdigest()
+        return self._get_hasher().hexdigest()
 
     @property
     def size(self):
         self._download_content_and_check_hash()
-        return os.path.getsize(self._file_path)
+        return self._backend.size()
 
     # HELPERS
     def _open(self, mode):
-        return open(self._file_path, mode)
+        return self._backend.open(mode)
+
+    def _get_hasher(self):
+        if self._hasher is None:
+            # content was not written through this object, so hash it once
+            chunk_size = 1024 * 1024  # 1 MB
+            hasher = SHA3_256.new(update_after_digest=True)
+            with self._open('rb') as f:
+                while True:
+                    chunk = f.read(chunk_size)
+                    if chunk:
+                        hasher.update(chunk)
+                    else:
+                        break
+            self._hasher = hasher
+        return self._hasher
 
     # READ
     def download_content(self):
         raise NotImplementedError
 
     def _download_content(self):
-        if not os.path.isfile(self._file_path):
-            with open(self._file_path, 'ab'):
+        if not self._backend.exists():
+            with self._open('ab'):
                 pass
-            self.download_content()
+            try:
+                self.download_content()
+            except BaseException:
+                # partial content must not be mistaken for the downloaded content
+                self.cleanup()
+                raise
             self._initial_hash = self.hash
             return True
         else:
@@ -90,6 +163,12 @@ class CachedObject:
         with self._open('rb') as f:
             return f.read()
 
+    def read_range(self, offset, length):
+        self._download_content_and_check_hash()
+        with self._open('rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
     def read_chunks(self, chunk_size=1024 * 1024):
         self._download_content_and_check_hash()
         with self._open('rb') as f:
@@ -101,23 +180,40 @@ class CachedObject:
                     break
 
     # WRITE
-    def _write(self, file_object, content):
+    def _write(self, file_object, content, hasher):
         self._is_changed = True
-        if isinstance(content, (bytes, str)):
-            # we can't write str, but we'll let the write function handle this
-            file_object.write(content)
-        else:
-            for c in content:
-                file_object.write(c)
+        try:
+            if isinstance(content, (bytes, str)):
+                # we can't write str, but we'll let the write function handle this
+                file_object.write(content)
+                hasher.update(content)
+            else:
+                for c in content:
+                    file_object.write(c)
+                    hasher.update(c)
+        except BaseException:
+            # the content on disk is no longer known, it will be hashed again when needed
+            self._hasher = None
+            raise
+        self._hasher = hasher
 
     def write(self, content):
         with self._open('wb') as f:
-            self._write(f, content)
+            self._write(f, content, SHA3_256.new(update_after_digest=True))
+
+    def write_file(self, file_path):
+        # the content becomes the file at file_path, which is linked instead of copied, so it must not change anymore
+        self._backend.remove()
+        os.link(file_path, self._file_path)
+        self._backend = FileBackend(self._file_path)
+        self._hasher = None
+        self._is_changed = True
 
     def append(self, content):
         self._download_content_and_check_hash()
+        hasher = self._get_hasher()
         with self._open('ab') as f:
-            self._write(f, content)
+            self._write(f, content, hasher)
 
     # CLOSE
     def upload_content(self):
@@ -127,10 +223,8 @@ class CachedObject:
         self.upload_content()
 
     def cleanup(self):
-        try:
-            os.remove(self._file_path)
-        except OSError:
-            pass
+        self._hasher = None
+        self._backend.remove()
 
     def close(self):
         try:
@@ -0,0 +1,122 @@
+import os
+
+
+class FileBackend:
+    def __init__(self, file_path):
+        self._file_path = file_path
+
+    def exists(self):
+        return os.path.isfile(self._file_path)
+
+    def size(self):
+        return os.path.getsize(self._file_path)
+
+    def open(self, mode):
+        return open(self._file_path, mode)
+
+    def remove(self):
+        try:
+            os.remove(self._file_path)
+        except OSError:
+            pass
+
+
+class MemoryFile:
+    # minimal file object on top of a MemoryBackend, for the modes used by CachedObject: rb, wb and ab
+    def __init__(self, backend, mode):
+        self._backend = backend
+        self._position = 0
+        self._spill_file = None
+
+        if mode == 'rb':
+            if backend._content is None:
+                raise FileNotFoundError(backend._file_backend._file_path)
+        elif mode == 'wb':
+            backend._content = b''
+        elif mode == 'ab':
+            if backend._content is None:
+                backend._content = b''
+        else:
+            raise ValueError('Unsupported mode: {}'.format(mode))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self._spill_file is not None:
+            self._spill_file.close()
+            self._spill_file = None
+
+    def seek(self, offset):
+        self._position = offset
+
+    def read(self, size=-1):
+        content = self._backend._content
+        if self._position == 0 and (size < 0 or size >= len(content)) and isinstance(content, bytes):
+            # no need to copy immutable content
+            self._position = len(content)
+            return content
+        end = len(content) if size < 0 else min(len(content), self._position + size)
+        data = bytes(memoryview(content)[self._position:end])
+        self._position = max(self._position, end)
+        return data
+
+    def write(self, data):
+        if not isinstance(data, bytes):
+            data = bytes(data)
+
+        backend = self._backend
+        if self._spill_file is None and len(backend._content) + len(data) > backend._max_size:
+            backend._spill()
+            self._spill_file = backend._file_backend.open('ab')
+
+        if self._spill_file is not None:
+            self._spill_file.write(data)
+        elif len(backend._content) == 0:
+            backend._content = data
+        else:
+            if not isinstance(backend._content, bytearray):
+                backend._content = bytearray(backend._content)
+            backend._content += data
+        return len(data)
+
+
+class MemoryBackend:
+    # keeps the content in memory, and moves it to a file once it grows beyond max_size
+    def __init__(self, file_path, max_size):
+        self._file_backend = FileBackend(file_path)
+        self._max_size = max_size
+        self._content = None
+        self._is_spilled = False
+
+    def exists(self):
+        if self._is_spilled:
+            return self._file_backend.exists()
+        return self._content is not None
+
+    def size(self):
+        if self._is_spilled:
+            return self._file_backend.size()
+        if self._content is None:
+            raise FileNotFoundError(self._file_backend._file_path)
+        return len(self._content)
+
+    def open(self, mode):
+        if self._is_spilled:
+            return self._file_backend.open(mode)
+        return MemoryFile(self, mode)
+
+    def remove(self):
+        self._content = None
+        if self._is_spilled:
+            self._file_backend.remove()
+            self._is_spilled = False
+
+    def _spill(self):
+        with self._file_backend.open('wb') as f:
+            f.write(self._content)
+        self._content = None
+        self._is_spilled = True
@@ -0,0 +1,173 @@
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from Crypto.Hash import SHA3_256
+
+from app.models.cache import LOCAL_CACHE
+from nimbus import config
+from nimbus.log import get_logger
+
+CONTENT_CACHE_DIR = os.path.join(LOCAL_CACHE, 'content')
+CONTENT_CACHE_MAX_BYTES = int(config.get('cache', 'content_max_bytes'))  # for all processes on the host together
+TMP_MAX_SECONDS = 3600  # a temporary file that is older was left behind by a process that stopped
+RESCAN_SECONDS = 60  # the entries added or removed by other processes are read from the directory this often
+
+logger = get_logger(__name__)
+
+
+class ContentCache:
+    # local copies of file contents, addressed by their hash and evicted when least recently used, the directory is
+    # shared by all processes on the host, so the entries are read from it again on a miss or put when the last scan
+    # is older than RESCAN_SECONDS
+    def __init__(self, directory, max_bytes):
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # hash -> size, least recently used first
+        self._size = 0
+        self._verified = set()  # hashes of the entries of which the content was checked by this process
+        self._loaded = None  # monotonic time of the last scan of the directory
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(self._directory, exist_ok=True)
+        with self._lock:
+            self._load()
+            self._evict()
+
+    def _path(self, content_hash):
+        return os.path.join(self._directory, content_hash)
+
+    def _load(self):
+        # the modification time is updated on every hit, so it gives the order of use
+        entries = []
+        now = time.time()
+        for name in os.listdir(self._directory):
+            path = os.path.join(self._directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                # removed by another process
+                continue
+            if name.endswith('.tmp'):
+                if stat.st_mtime < now - TMP_MAX_SECONDS:
+                    self._remove(path)
+                continue
+            entries.append((stat.st_mtime, name, stat.st_size))
+        self._entries = OrderedDict((name, size) for _, name, size in sorted(entries))
+        self._size = sum(self._entries.values())
+        self._verified.intersection_update(self._entries)
+        self._loaded = time.monotonic()
+
+    def _rescan(self):
+        if time.monotonic() - self._loaded >= RESCAN_SECONDS:
+            self._load()
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        while self._size > self._max_bytes:
+            content_hash, size = self._entries.popitem(last=False)
+            self._size -= size
+            self._verified.discard(content_hash)
+            self._remove(self._path(content_hash))
+
+    def open(self, content_hash):
+        # None on a miss, the cache is only an optimization so errors are misses as well
+        path = self._path(content_hash)
+        with self._lock:
+            try:
+                f = open(path, 'rb')
+            except OSError:
+                self.misses += 1
+                self._size -= self._entries.pop(content_hash, 0)
+                self._rescan()
+                logger.debug('Content cache miss: {}'.format(self.stats()))
+                return None
+            self.hits += 1
+            if content_hash not in self._entries:
+                # added by another process
+                self._entries[content_hash] = os.fstat(f.fileno()).st_size
+                self._size += self._entries[content_hash]
+            self._entries.move_to_end(content_hash)
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        logger.debug('Content cache hit: {}'.format(self.stats()))
+        return f
+
+    def open_verified(self, content_hash):
+        # like open, but the content is checked against its hash the first time this process opens it, so a corrupt
+        # entry is discarded instead of returned
+        f = self.open(content_hash)
+        if f is None or content_hash in self._verified:
+            return f
+        try:
+            hasher = SHA3_256.new()
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                hasher.update(chunk)
+            f.seek(0)
+        except OSError:
+            f.close()
+            return None
+        if hasher.hexdigest() != content_hash:
+            f.close()
+            logger.warning('Content cache entry {} is corrupt'.format(content_hash))
+            self.discard(content_hash)
+            return None
+        with self._lock:
+            if content_hash in self._entries:
+                self._verified.add(content_hash)
+        return f
+
+    def put(self, content_hash, content):
+        # the content must have been checked against content_hash
+        path = self._path(content_hash)
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), uuid.uuid4().hex)
+        size = 0
+        try:
+            with open(tmp_path, 'wb') as f:
+                for chunk in content:
+                    f.write(chunk)
+                    size += len(chunk)
+            if size > self._max_bytes:
+                self._remove(tmp_path)
+                return
+
+            with self._lock:
+                os.replace(tmp_path, path)
+                self._size += size - self._entries.pop(content_hash, 0)
+                self._entries[content_hash] = size
+                self._rescan()
+                self._verified.add(content_hash)
+                self._evict()
+        except OSError as e:
+            logger.warning('Could not add {} to the content cache: {}'.format(content_hash, e))
+            self._remove(tmp_path)
+
+    def discard(self, content_hash):
+        with self._lock:
+            self._size -= self._entries.pop(content_hash, 0)
+            self._verified.discard(content_hash)
+            self._remove(self._path(content_hash))
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self._entries),
+            'bytes': self._size,
+            'max_bytes': self._max_bytes,
+        }
+
+
+content_cache = ContentCache(CONTENT_CACHE_DIR, CONTENT_CACHE_MAX_BYTES)
@@ -1,7 +1,23 @@
-from pyeclib.ec_iface import ECDriver, ECInsufficientFragments
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import partial
+
+from Crypto.Hash import SHA3_256
+from pyeclib.ec_iface import ECDriver, ECDriverError
 
 from app.models.cache import CachedObject
-from app.models.error import HashError, ReconstructionError
+from app.models.cache.content import content_cache
+from app.models.cache.fragment import download_fragment_content
+from app.models.error import HashError, ReconstructionError, RemoteStorageError, DownloadFailed
+from app.models.hub import HUB_LOST
+from nimbus import config
+from nimbus.errors import ConnectionTimeoutError
+
+# number of fragment downloads in flight on top of the ones that are strictly needed
+DOWNLOAD_HEDGE = int(config.get('transfer', 'download_hedge'))
+
+# position of a stripe in the file, and of its encoded segment in every fragment
+Stripe = namedtuple('Stripe', ['index', 'offset', 'length', 'fragment_offset', 'fragment_length'])
 
 
 def ecdriver(encoding):
@@ -12,39 +28,235 @@ def ecdriver(encoding):
     )
 
 
+def get_stripes(encoding, size):
+    info = ecdriver(encoding).get_segment_info(size, encoding.stripe_size)
+    stripes = []
+    for i in range(info['num_segments']):
+        is_last = i == info['num_segments'] - 1
+        stripes.append(Stripe(
+            index=i,
+            offset=i * info['segment_size'],
+            length=info['last_segment_size'] if is_last else info['segment_size'],
+            fragment_offset=i * info['fragment_size'],
+            fragment_length=info['last_fragment_size'] if is_last else info['fragment_size'],
+        ))
+    return stripes
+
+
+def download_fragment(fragment):
+    with fragment as fr:
+        return fr.read()
+
+
+def get_segment_hash(data):
+    return SHA3_256.new(data).hexdigest()
+
+
+def download_fragment_stripe(fragment, stripe):
+    content = download_fragment_content(fragment.remote, fragment.uuid, stripe.fragment_offset, stripe.fragment_length)
+    if len(content) != stripe.fragment_length:
+        raise DownloadFailed('Segment {} of fragment {} is incomplete'.format(stripe.index, fragment.uuid))
+    # fragments stored before segments were hashed are only checked by the hash of the whole file
+    if fragment.segment_hashes and get_segment_hash(content) != fragment.segment_hashes[stripe.index]:
+        raise HashError('Segment {} of fragment {} is different from the expected hash'.format(
+            stripe.index, fragment.uuid
+        ))
+    return content
+
+
+def download_fragments(encoding, fragments, download=download_fragment):
+    # request k + hedge fragments at once and return as soon as the first k have arrived, fragments on lost hubs are
+    # only requested when nothing else is left
+    pending = sorted(fragments, key=lambda f: (f.remote.status == HUB_LOST, not f.is_clean))
+    running = {}
+    fragment_data = []
+    executor = ThreadPoolExecutor(max_workers=encoding.k + DOWNLOAD_HEDGE)
+    try:
+        while len(fragment_data) < encoding.k:
+            while pending and len(running) < encoding.k - len(fragment_data) + DOWNLOAD_HEDGE:
+                fragment = pending.pop(0)
+                running[executor.submit(download, fragment)] = fragment
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                fragment = running.pop(future)
+                try:
+                    fragment_data.append(future.result())
+                except (RemoteStorageError, HashError):
+                    # the File queues itself for reconstruction when its context ends
+                    fragment.is_clean = False
+                    fragment.save()
+                except ConnectionTimeoutError:
+                    pass
+    finally:
+        # downloads that are still in flight are not needed anymore
+        executor.shutdown(wait=False)
+    return fragment_data[:encoding.k]
+
+
 def download_file_content(encoding, fragments):
+    return ecdriver(encoding).decode(download_fragments(encoding, fragments))
+
+
+def download_file_stripe(ecd, encoding, fragments, stripe):
+    return ecd.decode(download_fragments(encoding, fragments, partial(download_fragment_stripe, stripe=stripe)))
+
+
+def download_file_stripes(encoding, size, fragments):
     ecd = ecdriver(encoding)
-    fragment_data = []
-    for fragment in fragments:
-        try:
-            with fragment as fr:
-                fragment_data.append(fr.read())
-        except HashError:
-            fragment.is_clean = False
-            fragment.save()
-            # TODO send out signal to reconstruct this file
-        if len(fragment_data) >= encoding.k:
-            break
-    return ecd.decode(fragment_data)
+    for stripe in get_stripes(encoding, size):
+        yield download_file_stripe(ecd, encoding, fragments, stripe)
+
+
+def download_file_range(encoding, size, fragments, offset, length):
+    # only the stripes that overlap with the range are downloaded, a negative length reads to the end of the file
+    end = size if length < 0 else min(size, offset + length)
+    if offset >= end:
+        return b''
+    ecd = ecdriver(encoding)
+    content = []
+    for stripe in get_stripes(encoding, size):
+        if stripe.offset + stripe.length <= offset or stripe.offset >= end:
+            continue
+        data = download_file_stripe(ecd, encoding, fragments, stripe)
+        content.append(data[max(0, offset - stripe.offset):end - stripe.offset])
+    return b''.join(content)
+
+
+def encode_file_content(encoding, cached_object):
+    # encode stripe by stripe, so only one stripe is in memory at any time
+    ecd = ecdriver(encoding)
+    stages = [CachedStripes() for _ in range(encoding.k + encoding.m)]
+    try:
+        for stripe in get_stripes(encoding, cached_object.size):
+            for stage, data in zip(stages, ecd.encode(cached_object.read_range(stripe.offset, stripe.length))):
+                stage.append_segment(data)
+    except Exception:
+        for stage in stages:
+            stage.cleanup()
+        raise
+    return stages
+
+
+def reconstruct_file_stripes(encoding, size, fragments, indexes, expected_hash):
+    # the fragments are decoded as well, so a corrupt fragment without segment hashes is not copied into new fragments
+    ecd = ecdriver(encoding)
+    stages = [CachedStripes() for _ in indexes]
+    hasher = SHA3_256.new()
+    try:
+        for stripe in get_stripes(encoding, size):
+            fragment_data = download_fragments(encoding, fragments, partial(download_fragment_stripe, stripe=stripe))
+            hasher.update(ecd.decode(fragment_data))
+            for stage, data in zip(stages, ecd.reconstruct(fragment_data, indexes)):
+                stage.append_segment(data)
+        if hasher.hexdigest() != expected_hash:
+            raise HashError('Reconstructed content is different from the expected hash ({} - {})'.format(
+                hasher.hexdigest(), expected_hash
+            ))
+    except Exception:
+        for stage in stages:
+            stage.cleanup()
+        raise
+    return stages
+
+
+class CachedStripes(CachedObject):
+    # local stage for the encoded stripes of one fragment, can be uploaded as fragment content
+    def __init__(self, *args, **kwargs):
+        self.segment_hashes = []
+        super().__init__(*args, **kwargs)
+
+    def append_segment(self, data):
+        self.append(data)
+        self.segment_hashes.append(get_segment_hash(data))
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return self.read_chunks()
+
+    def download_content(self):
+        pass
+
+    def upload_content(self):
+        pass
 
 
 class CachedFile(CachedObject):
-    def __init__(self, encoding, fragments, *args, **kwargs):
+    def __init__(self, encoding, fragments, size=None, *args, **kwargs):
         self._encoding = encoding
         self._fragments = fragments
+        self._size = size
         super().__init__(*args, **kwargs)
 
+    def _download_cached_content(self):
+        f = content_cache.open(self._expected_hash)
+        if f is None:
+            return False
+        try:
+            with f:
+                self.write(iter(lambda: f.read(1024 * 1024), b''))
+        except OSError:
+            # the content is downloaded instead
+            return False
+        if self.hash != self._expected_hash:
+            content_cache.discard(self._expected_hash)
+            return False
+        return True
+
     def download_content(self):
         if self._fragments.count() == 0:
             return
 
+        if self._expected_hash and self._download_cached_content():
+            return
+
+        try:
+            if self._encoding.stripe_size:
+                self.write(download_file_stripes(self._encoding, self._size, self._fragments))
+            else:
+                self.write(download_file_content(self._encoding, self._fragments))
+        except ECDriverError:
+            raise ReconstructionError(
+                'There are not enough fragments to reconstruct the file {}'.format(self._file_path)
+            )
+
+        if self._expected_hash and self.hash == self._expected_hash:
+            content_cache.put(self._expected_hash, self.read_chunks())
+
+    def _read_cached_range(self, offset, length):
+        # None when the content cache doesn't have the file
+        f = content_cache.open_verified(self._expected_hash) if self._expected_hash else None
+        if f is None:
+            return None
+        try:
+            with f:
+                f.seek(offset)
+                return f.read(length)
+        except OSError:
+            return None
+
+    def read_range(self, offset, length):
+        if self._backend.exists() or self._fragments.count() == 0:
+            return super().read_range(offset, length)
+
+        content = self._read_cached_range(offset, length)
+        if content is not None:
+            return content
+
+        # only the stripes of the range are downloaded, these are checked against the segment hashes of the
+        # fragments, otherwise the whole file is downloaded and checked, and added to the content cache
+        if not self._encoding.stripe_size or not all(fragment.segment_hashes for fragment in self._fragments):
+            return super().read_range(offset, length)
+
         try:
-            content = download_file_content(self._encoding, self._fragments)
-        except ECInsufficientFragments:
+            return download_file_range(self._encoding, self._size, self._fragments, offset, length)
+        except ECDriverError:
             raise ReconstructionError(
                 'There are not enough fragments to reconstruct the file {}'.format(self._file_path)
             )
-        self.write(content)
 
     def upload_content(self):
         # this is done on the File itself
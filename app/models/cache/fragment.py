@@ -1,28 +1,59 @@
 import requests
 
-from app.models.cache import CachedObject, get_client
+from app.models.cache import CachedObject, client_pool
 from app.models.error import DownloadFailed, InsufficientStorageSpace, UploadFailed, DeleteFailed
+from app.models.hub import Hub
 
+# fragments larger than this are transferred in multiple requests
+FRAGMENT_SEGMENT_SIZE = 4 * 1024 * 1024  # 4 MB
+# limits of the batch requests that handle multiple fragments at once
+BATCH_SIZE = 1000
+BATCH_MAX_BYTES = 64 * 1024 * 1024  # 64 MB
 
-def download_fragment_hash(hub, fragment_uuid):
-    response = get_client().get(hub.cumulus_id + '/hash', parameters={'uuid': fragment_uuid})
+
+def batches(items, size=BATCH_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def download_fragment_hash(hub, fragment_uuid, verify=False):
+    # with verify, the hub hashes the content again instead of returning the stored hash
+    parameters = {'uuid': fragment_uuid}
+    if verify:
+        parameters['verify'] = True
+    with client_pool.client() as client:
+        response = client.get(hub.cumulus_id + '/hash', parameters=parameters)
     if response.status_code not in (requests.codes.ok, requests.codes.not_found):
         raise DownloadFailed()
     return response.response['hash']
 
 
-def download_fragment_content(hub, fragment_uuid):
-    response = get_client().get(hub.cumulus_id + '/file', parameters={'uuid': fragment_uuid}, decode_response=False)
-    if response.status_code not in (requests.codes.ok, requests.codes.not_found):
+def download_fragment_content(hub, fragment_uuid, offset=None, length=None):
+    parameters = {'uuid': fragment_uuid}
+    if offset is not None:
+        parameters['offset'] = offset
+    if length is not None:
+        parameters['length'] = length
+    with client_pool.client() as client:
+        response = client.get(hub.cumulus_id + '/file', parameters=parameters, decode_response=False)
+    if response.status_code != requests.codes.ok:
         raise DownloadFailed()
     return response.response[b'content']
 
 
-def upload_fragment_content(hub, fragment_uuid, content):
-    response = get_client().post(hub.cumulus_id + '/file', data={
+def upload_fragment_content(hub, fragment_uuid, content, offset=None, is_last=True, size=None):
+    # size is of the whole fragment when it is sent in segments, the hub checks its free space against it
+    data = {
         'uuid': fragment_uuid,
         'content': content
-    })
+    }
+    if offset is not None:
+        data['offset'] = offset
+        data['is_last'] = is_last
+        data['size'] = size
+    with client_pool.client() as client:
+        response = client.post(hub.cumulus_id + '/file', data=data)
 
     if response.status_code == requests.codes.ok:
         store_available_bytes(hub, response.response['available_bytes'])
@@ -34,7 +65,8 @@ def upload_fragment_content(hub, fragment_uuid, content):
 
 
 def remove_fragment_content(hub, fragment_uuid):
-    response = get_client().delete(hub.cumulus_id + '/file', parameters={'uuid': fragment_uuid})
+    with client_pool.client() as client:
+        response = client.delete(hub.cumulus_id + '/file', parameters={'uuid': fragment_uuid})
 
     if response.status_code == requests.codes.ok:
         store_available_bytes(hub, response.response['available_bytes'])
@@ -42,9 +74,72 @@ def remove_fragment_content(hub, fragment_uuid):
         raise DeleteFailed()
 
 
+def download_fragment_hashes(hub, fragment_uuids):
+    # fragments that the hub hasn't hashed yet are not included, fragments that don't exist have an empty hash
+    hashes = {}
+    for batch in batches(fragment_uuids):
+        while batch:
+            with client_pool.client() as client:
+                response = client.get(hub.cumulus_id + '/hashes', parameters={'uuids': batch})
+            if response.status_code != requests.codes.ok:
+                raise DownloadFailed()
+            hashes.update(response.response['hashes'])
+            batch = response.response['remaining']
+    return hashes
+
+
+def download_fragment_sizes(hub, fragment_uuids):
+    # fragments that don't exist on the hub are not included
+    sizes = {}
+    for batch in batches(fragment_uuids):
+        with client_pool.client() as client:
+            response = client.list(hub.cumulus_id + '/files', parameters={'uuids': batch})
+        if response.status_code != requests.codes.ok:
+            raise DownloadFailed()
+        sizes.update(response.response['sizes'])
+    return sizes
+
+
+def download_fragments_content(hub, fragment_uuids, max_bytes=BATCH_MAX_BYTES):
+    # fragments that don't exist on the hub are not included
+    contents = {}
+    for batch in batches(fragment_uuids):
+        while batch:
+            with client_pool.client() as client:
+                response = client.get(hub.cumulus_id + '/files',
+                                      parameters={'uuids': batch, 'max_bytes': max_bytes},
+                                      decode_response=False)
+            if response.status_code != requests.codes.ok:
+                raise DownloadFailed()
+            for fragment_uuid, content in response.response[b'contents'].items():
+                contents[fragment_uuid.decode()] = content
+            batch = [fragment_uuid.decode() for fragment_uuid in response.response[b'remaining']]
+    return contents
+
+
+def remove_fragments_content(hub, fragment_uuids):
+    for batch in batches(fragment_uuids):
+        with client_pool.client() as client:
+            response = client.delete(hub.cumulus_id + '/files', parameters={'uuids': batch})
+
+        if response.status_code == requests.codes.ok:
+            store_available_bytes(hub, response.response['available_bytes'])
+        else:
+            raise DeleteFailed()
+
+
+def download_hub_stats(hub):
+    with client_pool.client() as client:
+        response = client.get(hub.cumulus_id + '/stats')
+    if response.status_code != requests.codes.ok:
+        raise DownloadFailed()
+    return response.response
+
+
 def store_available_bytes(hub, available_bytes):
+    # only this field is written, so concurrent updates of the hub by other workers are kept
     hub.available_bytes = available_bytes
-    hub.save()
+    Hub.objects(cumulus_id=hub.cumulus_id).update_one(set__available_bytes=available_bytes)
 
 
 class CachedFragment(CachedObject):
@@ -53,9 +148,24 @@ class CachedFragment(CachedObject):
         self._uuid = uuid
         super().__init__(*args, **kwargs)
 
+    def _download_segments(self):
+        offset = 0
+        while True:
+            content = download_fragment_content(self._remote, self._uuid, offset, FRAGMENT_SEGMENT_SIZE)
+            yield content
+            if len(content) < FRAGMENT_SEGMENT_SIZE:
+                break
+            offset += len(content)
+
     def download_content(self):
-        content = download_fragment_content(self._remote, self._uuid)
-        self.write(content)
+        self.write(self._download_segments())
 
     def upload_content(self):
-        upload_fragment_content(self._remote, self._uuid, self.read())
+        if self.size <= FRAGMENT_SEGMENT_SIZE:
+            upload_fragment_content(self._remote, self._uuid, self.read())
+        else:
+            offset = 0
+            for chunk in self.read_chunks(FRAGMENT_SEGMENT_SIZE):
+                is_last = offset + len(chunk) >= self.size
+                upload_fragment_content(self._remote, self._uuid, chunk, offset, is_last, self.size)
+                offset += len(chunk)
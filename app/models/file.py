@@ -1,71 +1,112 @@
-import copy
-import random
+import threading
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
 
 from mongoengine import EmbeddedDocument, StringField, IntField, Document, ReferenceField, EmbeddedDocumentField, \
-    EmbeddedDocumentListField
+    EmbeddedDocumentListField, NotUniqueError
 from pyeclib.ec_iface import ECDriverError
 
 from app.helpers import one
-from app.models.cache.file import CachedFile, ecdriver
+from app.models.cache.file import CachedFile, CachedStripes, ecdriver, download_fragments, encode_file_content, \
+    reconstruct_file_stripes
 from app.models.error import ReconstructionError, NoRemoteStorageLocationFound, RemoteStorageError, HashError
 from app.models.fragment import Fragment, OrphanedFragment
-from app.models.hub import Hub
+from app.models.placement import hub_index
+from app.models.reconstruction import ReconstructionTask
+from nimbus import config
 from nimbus.errors import ConnectionTimeoutError
 from nimbus.helpers.timestamp import get_utc_int
 
+UPLOAD_WORKERS = int(config.get('transfer', 'upload_workers'))
 
-def select_remote_storage_location(file, size, exclude_locations=None):
-    # naive approach:
-    # - never include the source
-    # - never include explicitly excluded locations
-    # - when there are no valid storage locations anymore, just use already used locations
+# hub selection and registration of the selected hub must happen atomically when uploading in parallel
+_selection_lock = threading.Lock()
 
-    base_exclude = {file.source}.union(set(exclude_locations))
 
-    exclude = copy.copy(base_exclude)
-    for fragment in file.fragments:
-        exclude.add(fragment.remote)
+def select_remote_storage_locations(file, fragment_uuids, size, exclude_locations=None, used_locations=None):
+    return hub_index.select(file, fragment_uuids, size, exclude_locations, used_locations)
 
-    while True:
-        query = Hub.objects \
-            .filter(cumulus_id__nin=[h.cumulus_id for h in exclude]) \
-            .filter(available_bytes__gt=size)
-        hub_count = query.count()
-        if hub_count == 0:
-            if exclude == base_exclude:
-                raise NoRemoteStorageLocationFound
-            else:
-                exclude = copy.copy(base_exclude)
-        else:
-            break
 
-    hub_select = random.randint(0, hub_count - 1)
-    return query[hub_select]
+def select_remote_storage_location(file, fragment_uuid, size, exclude_locations=None, used_locations=None):
+    return select_remote_storage_locations(file, [fragment_uuid], size, exclude_locations, used_locations)[0]
 
 
-def create_file_fragment(file, index, data, exclude_hubs_for_storage):
+def create_file_fragment(file, index, data, exclude_hubs_for_storage, used_hubs_for_storage=None, remote=None,
+                         fragment_uuid=None):
+    # remote is the hub reserved upfront for fragment_uuid, another one is reserved when it fails
+    if used_hubs_for_storage is None:
+        used_hubs_for_storage = []
+    if fragment_uuid is None:
+        fragment_uuid = uuid.uuid4().hex
     while True:
-        remote = select_remote_storage_location(
-            file=file,
-            size=int(len(data) * 1.10),
-            exclude_locations=exclude_hubs_for_storage
-        )
-        fragment = Fragment(index=index, remote=remote)
+        if remote is None:
+            with _selection_lock:
+                remote = select_remote_storage_location(
+                    file=file,
+                    fragment_uuid=fragment_uuid,
+                    size=len(data),
+                    exclude_locations=exclude_hubs_for_storage,
+                    used_locations=used_hubs_for_storage
+                )
+                used_hubs_for_storage.append(remote)
+        fragment = Fragment(uuid=fragment_uuid, index=index, remote=remote)
+        if isinstance(data, CachedStripes):
+            fragment.segment_hashes = data.segment_hashes
+        start = time.perf_counter()
         try:
             with fragment as fr:
                 fr.write(data)
         except (RemoteStorageError, ConnectionTimeoutError):
-            exclude_hubs_for_storage.append(remote)
+            hub_index.record_latency(remote, time.perf_counter() - start, len(data))
+            hub_index.release(remote, fragment_uuid)
+            with _selection_lock:
+                exclude_hubs_for_storage.append(remote)
+            remote = None
             continue
+        # the fragment is included in the available bytes reported by the hub now
+        hub_index.record_latency(remote, time.perf_counter() - start, len(data))
+        hub_index.release(remote, fragment_uuid)
         break
     return fragment
 
 
+def create_file_fragments(file, fragment_data, exclude_hubs_for_storage):
+    # select the hubs for all fragments at once and upload in parallel, every upload retries on another hub by itself
+    fragment_data = list(fragment_data)
+    if not fragment_data:
+        return
+    fragment_uuids = [uuid.uuid4().hex for _ in fragment_data]
+    with _selection_lock:
+        remotes = select_remote_storage_locations(
+            file=file,
+            fragment_uuids=fragment_uuids,
+            size=max(len(data) for _, data in fragment_data),
+            exclude_locations=exclude_hubs_for_storage
+        )
+        used_hubs_for_storage = list(remotes)
+
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+        futures = [
+            executor.submit(create_file_fragment, file, index, data,
+                            exclude_hubs_for_storage, used_hubs_for_storage, remote, fragment_uuid)
+            for (index, data), remote, fragment_uuid in zip(fragment_data, remotes, fragment_uuids)
+        ]
+        wait(futures)
+
+    # register all uploaded fragments before raising, so they can be cleaned up
+    for future in futures:
+        if future.exception() is None:
+            file.fragments.append(future.result())
+    for future in futures:
+        future.result()
+
+
 class Encoding(EmbeddedDocument):
     name = StringField(required=True)
     k = IntField(required=True)  # number of file pieces
     m = IntField(required=True)  # number of parity blocks
+    stripe_size = IntField()  # files are encoded in stripes of this size, or as a whole when not set
 
 
 class File(Document):
@@ -75,9 +116,21 @@ class File(Document):
     collection = StringField(required=True)
     filename = StringField(required=True)
     hash = StringField(required=True)
+    size = IntField()
     encoding = EmbeddedDocumentField(Encoding, required=True)
     fragments = EmbeddedDocumentListField(Fragment, required=True)
 
+    meta = {
+        # building indexes on a large collection takes long, so they are created by app/tasks/ensure_indexes.py
+        'auto_create_index': False,
+        'indexes': [
+            {'fields': ['source', 'collection', 'filename'], 'unique': True},
+            ('source', 'uuid'),  # listing the files of a source
+            'fragments.remote',  # evacuation and verification per hub
+            'fragments.is_clean',  # reconstruction
+        ],
+    }
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._cache = None
@@ -97,10 +150,19 @@ class File(Document):
             raise ValueError('You must define the filename before using the File.')
         if self.encoding is None:
             raise ValueError('You must define the encoding before using the File.')
-        self._cache = CachedFile(encoding=self.encoding, fragments=self.fragments, expected_hash=self.hash)
+        self._cache = CachedFile(encoding=self.encoding, fragments=self.fragments, size=self.size,
+                                 expected_hash=self.hash)
         return self._cache
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        if not all(fragment.is_clean for fragment in self.fragments):
+            # a fragment failed while reading
+            ReconstructionTask.enqueue(self)
+        if exc_type is not None:
+            # the content is incomplete when reading or writing failed, so it must not replace the stored content
+            self._cache.cleanup()
+            self._cache = None
+            return
         try:
             if self.hash != self._cache.hash:
                 orphan_fragments = self._remove_fragments(delay=True, reason='file_content_replaced')
@@ -114,19 +176,42 @@ class File(Document):
                 orphan_fragment.save()
         except (RemoteStorageError, NoRemoteStorageLocationFound):
             # if upload fails: remove previously uploaded fragments, clean up and raise
-            self._remove_fragments('file_upload_cancelled')
+            self._remove_fragments(reason='file_upload_cancelled')
             self._cache.close()
             self._cache = None
             raise
+        except NotUniqueError:
+            # the same file was created by another upload at the same time
+            self._remove_fragments(reason='file_upload_cancelled')
+            raise
+
+    def read_range(self, offset, length):
+        if self._cache is not None:
+            raise RuntimeError('Cannot call this function when in a context manager.')
+        if offset < 0 or length < -1:
+            raise ValueError('The offset must be at least 0 and the length at least -1.')
+        cache = CachedFile(encoding=self.encoding, fragments=self.fragments, size=self.size, expected_hash=self.hash)
+        try:
+            return cache.read_range(offset, length)
+        finally:
+            cache.cleanup()
+            if not all(fragment.is_clean for fragment in self.fragments):
+                # a fragment failed while reading
+                ReconstructionTask.enqueue(self)
 
     def _upload_content(self):
         self.hash = self._cache.hash
-        ecd = ecdriver(self.encoding)
-        exclude_hubs_for_storage = []
-        for fragment_index, fragment_data in enumerate(ecd.encode(self._cache.read())):
-            self.fragments.append(create_file_fragment(
-                self, fragment_index, fragment_data, exclude_hubs_for_storage
-            ))
+        self.size = self._cache.size
+        if self.encoding.stripe_size:
+            stages = encode_file_content(self.encoding, self._cache)
+            try:
+                create_file_fragments(self, enumerate(stages), [])
+            finally:
+                for stage in stages:
+                    stage.cleanup()
+        else:
+            ecd = ecdriver(self.encoding)
+            create_file_fragments(self, enumerate(ecd.encode(self._cache.read())), [])
 
     def _remove_fragment(self, index, delay=False, reason=None):
         fragment = one(self.fragments.filter(index=index))
@@ -150,36 +235,61 @@ class File(Document):
         if self._cache is not None:
             raise RuntimeError('Cannot call this function when in a context manager.')
 
+        if self.encoding.stripe_size:
+            self._reconstruct_stripes()
+            return
+
+        if all(fragment.is_clean for fragment in self.fragments):
+            return
+
+        # healthy fragments are downloaded concurrently, a failing download is replaced by another healthy fragment
+        fragment_data = download_fragments(self.encoding, [f for f in self.fragments if f.is_clean])
+        if len(fragment_data) < self.encoding.k:
+            raise ReconstructionError('There are not enough fragments to reconstruct {}'.format(self))
+
+        # downloads that failed are reconstructed as well
+        reconstruction_indexes = [f.index for f in self.fragments.filter(is_clean=False)]
         ecd = ecdriver(self.encoding)
+        try:
+            reconstruction_data = ecd.reconstruct(fragment_data, reconstruction_indexes)
+        except ECDriverError:
+            raise ReconstructionError('There are not enough fragments to reconstruct {}'.format(self))
 
-        # retrieve data to be used for reconstruction
-        fragment_data = []
-        while True:
-            reconstruction_indexes = [f.index for f in self.fragments.filter(is_clean=False)]
-            try:
-                indexes = ecd.fragments_needed(reconstruction_indexes)
-            except ECDriverError:
-                raise ReconstructionError('There are not enough fragments to reconstruct {}'.format(self))
+        self._replace_fragments(reconstruction_indexes, reconstruction_data)
+
+    def _reconstruct_stripes(self):
+        reconstruction_indexes = [f.index for f in self.fragments.filter(is_clean=False)]
+        if not reconstruction_indexes:
+            return
+        healthy_fragments = [f for f in self.fragments if f.index not in reconstruction_indexes]
+        try:
+            stages = reconstruct_file_stripes(self.encoding, self.size, healthy_fragments, reconstruction_indexes,
+                                              self.hash)
+        except (ECDriverError, HashError):
+            raise ReconstructionError('There are not enough fragments to reconstruct {}'.format(self))
+
+        try:
+            self._replace_fragments(reconstruction_indexes, stages)
+        finally:
+            for stage in stages:
+                stage.cleanup()
+
+    def _replace_fragments(self, indexes, fragment_data):
+        # the damaged fragments are only removed when all replacements are uploaded
+        damaged_fragments = [one(self.fragments.filter(index=index)) for index in indexes]
+        orphan_fragments = [self._remove_fragment(index, delay=True, reason='reconstructed') for index in indexes]
+        try:
+            create_file_fragments(self, zip(indexes, fragment_data), [])
+        except (RemoteStorageError, NoRemoteStorageLocationFound):
             for index in indexes:
-                fragment = self.fragments.filter(index=index).first()
-                try:
-                    with fragment as fr:
-                        fragment_data.append(fr.read())
-                except (RemoteStorageError, HashError):
-                    fragment.is_clean = False
-                    fragment.save()
-            if len(fragment_data) >= len(indexes):
-                break
-
-        # reconstruct
-        reconstruction_data = ecd.reconstruct(fragment_data, reconstruction_indexes)
-        for index, data in zip(reconstruction_indexes, reconstruction_data):
-            self._remove_fragment(index, reason='reconstructed')
-            self.fragments.append(create_file_fragment(
-                self, index, data, []
-            ))
+                if self.fragments.filter(index=index).count():
+                    self._remove_fragment(index, reason='reconstruction_cancelled')
+            self.fragments.extend(damaged_fragments)
+            raise
 
         self.save()
+        for orphan_fragment in orphan_fragments:
+            orphan_fragment.save()
 
     def verify_full(self):
         if self._cache is not None:
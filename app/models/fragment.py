@@ -1,6 +1,6 @@
 import uuid
 
-from mongoengine import EmbeddedDocument, StringField, IntField, ReferenceField, Document, BooleanField
+from mongoengine import EmbeddedDocument, StringField, IntField, ReferenceField, Document, BooleanField, ListField
 
 from app.models.cache.fragment import CachedFragment, remove_fragment_content, download_fragment_hash
 from app.models.error import RemoteStorageError, \
@@ -16,6 +16,7 @@ class Fragment(EmbeddedDocument):
     remote = ReferenceField('Hub', required=True)
     hash = StringField(required=True)
     is_clean = BooleanField(required=True, default=True)
+    segment_hashes = ListField(StringField())  # hash of every stripe segment, for files that are encoded in stripes
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -51,8 +52,15 @@ class Fragment(EmbeddedDocument):
                 fr.read()
         except ConnectionTimeoutError:
             self.is_clean = False
+        except RemoteStorageError:
+            self.is_clean = False
         except HashError:
             self.is_clean = False
+            # the hash stored by the hub may still match, correct it so hash verification detects the fragment too
+            try:
+                download_fragment_hash(self.remote, self.uuid, verify=True)
+            except (RemoteStorageError, ConnectionTimeoutError):
+                pass
         else:
             self.is_clean = True
         return self.is_clean
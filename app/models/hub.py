@@ -1,9 +1,68 @@
 import uuid
 
-from mongoengine import Document, StringField, IntField
+from mongoengine import Document, StringField, IntField, EmbeddedDocument, EmbeddedDocumentListField
+
+from nimbus.helpers.timestamp import get_utc_int
+
+HUB_ACTIVE = 'active'
+HUB_DRAINING = 'draining'  # fragments can still be read, but are moved to other hubs
+HUB_LOST = 'lost'  # fragments can't be read anymore and must be reconstructed
+HUB_STATUSES = (HUB_ACTIVE, HUB_DRAINING, HUB_LOST)
+
+
+class Reservation(EmbeddedDocument):
+    fragment = StringField(required=True)  # uuid of the fragment that is being uploaded
+    size = IntField(required=True)
+    timestamp_expires = IntField(required=True)
 
 
 class Hub(Document):
     reference = StringField(required=True)
     cumulus_id = StringField(primary_key=True, default=lambda: 'CML-' + uuid.uuid4().hex)
     available_bytes = IntField(required=True, default=1 * 1024 * 1024 * 1024 * 1024)  # set default to 1 TB available
+    status = StringField(required=True, default=HUB_ACTIVE, choices=HUB_STATUSES)
+    reservations = EmbeddedDocumentListField(Reservation)  # uploads in progress, not yet in available_bytes
+
+    @property
+    def reserved_bytes(self):
+        now = get_utc_int()
+        return sum(reservation.size for reservation in self.reservations if reservation.timestamp_expires > now)
+
+    def reserve(self, fragment_uuid, size, seconds):
+        # atomically, returns False when the hub doesn't have size bytes left or doesn't accept fragments anymore,
+        # expired reservations don't count
+        now = get_utc_int()
+        reservation = Reservation(fragment=fragment_uuid, size=size, timestamp_expires=now + seconds)
+        reserved_bytes = {'$sum': {'$map': {
+            'input': {'$filter': {
+                'input': {'$ifNull': ['$reservations', []]},
+                'as': 'reservation',
+                'cond': {'$gt': ['$$reservation.timestamp_expires', now]},
+            }},
+            'as': 'reservation',
+            'in': '$$reservation.size',
+        }}}
+        result = self._get_collection().update_one(
+            {
+                '_id': self.cumulus_id,
+                'status': HUB_ACTIVE,
+                '$expr': {'$gt': [{'$subtract': ['$available_bytes', reserved_bytes]}, size]},
+            },
+            {'$push': {'reservations': reservation.to_mongo()}}
+        )
+        return result.modified_count == 1
+
+    def release(self, fragment_uuid):
+        self._get_collection().update_one(
+            {'_id': self.cumulus_id},
+            {'$pull': {'reservations': {'fragment': fragment_uuid}}}
+        )
+
+    @classmethod
+    def expire_reservations(cls):
+        # reservations of uploads that never finished, e.g. because the proxy worker stopped
+        now = get_utc_int()
+        cls._get_collection().update_many(
+            {'reservations.timestamp_expires': {'$lte': now}},
+            {'$pull': {'reservations': {'timestamp_expires': {'$lte': now}}}}
+        )
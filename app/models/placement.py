@@ -0,0 +1,162 @@
+import hashlib
+import random
+import threading
+import time
+
+from app.models.error import NoRemoteStorageLocationFound
+from app.models.hub import Hub, HUB_DRAINING, HUB_LOST
+from nimbus import config
+
+PLACEMENT_REFRESH_SECONDS = int(config.get('placement', 'refresh_seconds'))
+PLACEMENT_STRATEGY = config.get('placement', 'strategy')
+PLACEMENT_RESERVATION_SECONDS = int(config.get('placement', 'reservation_seconds'))  # for uploads that never finish
+LATENCY_WEIGHT = 0.2  # weight of a new latency measurement in the moving average
+
+
+class UniformStrategy:
+    # every hub has the same chance
+    def choose(self, hub_index, candidates, key):
+        return random.choice(candidates)
+
+
+class FreeSpaceStrategy:
+    # the chance of a hub is proportional to its free space, so small hubs don't fill up first
+    def choose(self, hub_index, candidates, key):
+        return random.choices(candidates, weights=[hub_index.available_bytes(hub) for hub in candidates])[0]
+
+
+class LatencyStrategy:
+    # power of two choices: the fastest of two random hubs, hubs without measurements count as fastest
+    def choose(self, hub_index, candidates, key):
+        if len(candidates) == 1:
+            return candidates[0]
+        return min(random.sample(candidates, 2), key=hub_index.latency)
+
+
+class RendezvousStrategy:
+    # the same key always gives the same hubs, as long as these hubs are available
+    def choose(self, hub_index, candidates, key):
+        return max(candidates, key=lambda hub: hashlib.sha256((key + hub.cumulus_id).encode()).digest())
+
+
+STRATEGIES = {
+    'uniform': UniformStrategy,
+    'free_space': FreeSpaceStrategy,
+    'latency': LatencyStrategy,
+    'rendezvous': RendezvousStrategy,
+}
+
+
+class HubIndex:
+    # in-process view of the hubs that accept fragments, so selecting hubs doesn't need mongodb
+    def __init__(self, refresh_seconds, reservation_seconds, strategy):
+        self._refresh_seconds = refresh_seconds
+        self._reservation_seconds = reservation_seconds
+        self._strategy = strategy
+        self._latencies = {}  # moving average of the upload latency per hub, in seconds per MB
+        self._lock = threading.Lock()
+        self._hubs = []
+        self._reserved_bytes = {}  # bytes reserved per hub by this process since the last refresh
+        self._reservations = {}  # hub and size per fragment uuid, for the reservations in _reserved_bytes
+        self._timestamp_refreshed = None
+
+    def _refresh(self):
+        # reservations made before the refresh are included in the reservations of the hubs themselves
+        self._hubs = list(Hub.objects(status__nin=[HUB_DRAINING, HUB_LOST]))
+        self._reserved_bytes = {}
+        self._reservations = {}
+        self._timestamp_refreshed = time.monotonic()
+
+    def invalidate(self):
+        with self._lock:
+            self._timestamp_refreshed = None
+
+    def _add_reservation(self, hub, fragment_uuid, size):
+        self._reserved_bytes[hub.cumulus_id] = self._reserved_bytes.get(hub.cumulus_id, 0) + size
+        self._reservations[fragment_uuid] = (hub.cumulus_id, size)
+
+    def _remove_reservation(self, fragment_uuid):
+        hub_id, size = self._reservations.pop(fragment_uuid, (None, 0))
+        if hub_id is not None:
+            self._reserved_bytes[hub_id] -= size
+
+    def available_bytes(self, hub):
+        return hub.available_bytes - hub.reserved_bytes - self._reserved_bytes.get(hub.cumulus_id, 0)
+
+    def latency(self, hub):
+        return self._latencies.get(hub.cumulus_id, 0)
+
+    def record_latency(self, hub, seconds, size):
+        # uploads below 1 MB count as 1 MB, so small uploads measure latency and large ones throughput
+        latency = seconds / max(1, size / (1024 * 1024))
+        with self._lock:
+            previous = self._latencies.get(hub.cumulus_id)
+            if previous is None:
+                self._latencies[hub.cumulus_id] = latency
+            else:
+                self._latencies[hub.cumulus_id] = (1 - LATENCY_WEIGHT) * previous + LATENCY_WEIGHT * latency
+
+    def _choose(self, file, size, base_exclude, exclude):
+        with self._lock:
+            if self._timestamp_refreshed is None or \
+                    time.monotonic() - self._timestamp_refreshed > self._refresh_seconds:
+                self._refresh()
+
+            while True:
+                candidates = [hub for hub in self._hubs
+                              if hub.cumulus_id not in exclude and self.available_bytes(hub) > size]
+                if candidates:
+                    break
+                if exclude == base_exclude:
+                    raise NoRemoteStorageLocationFound
+                exclude.clear()
+                exclude.update(base_exclude)
+
+            return self._strategy.choose(self, candidates, file.uuid)
+
+    def _reserve(self, hub, fragment_uuid, size):
+        if not hub.reserve(fragment_uuid, size, self._reservation_seconds):
+            return False
+        with self._lock:
+            self._add_reservation(hub, fragment_uuid, size)
+        return True
+
+    def release(self, hub, fragment_uuid):
+        # when the upload of the fragment has finished or failed
+        hub.release(fragment_uuid)
+        with self._lock:
+            self._remove_reservation(fragment_uuid)
+
+    def select(self, file, fragment_uuids, size, exclude_locations=None, used_locations=None):
+        # naive approach:
+        # - never include the source
+        # - never include explicitly excluded locations
+        # - when there are no valid storage locations anymore, just use already used locations
+        # every selected hub has size bytes reserved for the fragment, until it is released or expires
+        base_exclude = {file.source.cumulus_id}.union(hub.cumulus_id for hub in exclude_locations or [])
+
+        exclude = set(base_exclude)
+        exclude.update(fragment.remote.cumulus_id for fragment in file.fragments)
+        exclude.update(hub.cumulus_id for hub in used_locations or [])
+
+        selected = []
+        try:
+            for fragment_uuid in fragment_uuids:
+                while True:
+                    hub = self._choose(file, size, base_exclude, exclude)
+                    if self._reserve(hub, fragment_uuid, size):
+                        break
+                    # other proxy workers have filled the hub, or it is evacuated, since the last refresh
+                    self.invalidate()
+                    base_exclude.add(hub.cumulus_id)
+                    exclude.add(hub.cumulus_id)
+                selected.append(hub)
+                exclude.add(hub.cumulus_id)
+        except NoRemoteStorageLocationFound:
+            for hub, fragment_uuid in zip(selected, fragment_uuids):
+                self.release(hub, fragment_uuid)
+            raise
+        return selected
+
+
+hub_index = HubIndex(PLACEMENT_REFRESH_SECONDS, PLACEMENT_RESERVATION_SECONDS, STRATEGIES[PLACEMENT_STRATEGY]())
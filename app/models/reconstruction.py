@@ -0,0 +1,47 @@
+from mongoengine import Document, StringField, IntField
+
+from nimbus.helpers.timestamp import get_utc_int
+
+
+class ReconstructionTask(Document):
+    file = StringField(primary_key=True)  # uuid of the file to reconstruct
+    priority = IntField(required=True)  # healthy fragments beyond the k that are needed, lowest first
+    revision = IntField(required=True, default=1)  # increased when the file is queued again
+    timestamp_queued = IntField(required=True, default=get_utc_int)
+    timestamp_lease_expires = IntField(required=True, default=0)
+    owner = StringField()
+    attempts = IntField(required=True, default=0)
+    last_error = StringField()
+
+    meta = {
+        'indexes': [('priority', 'timestamp_queued')],
+    }
+
+    @classmethod
+    def enqueue(cls, file):
+        healthy_count = len([fragment for fragment in file.fragments if fragment.is_clean])
+        cls.objects(file=file.uuid).update_one(
+            upsert=True,
+            min__priority=healthy_count - file.encoding.k,
+            inc__revision=1,
+            set_on_insert__timestamp_queued=get_utc_int(),
+            set_on_insert__timestamp_lease_expires=0,
+            set_on_insert__attempts=0,
+        )
+
+    @classmethod
+    def lease(cls, owner, lease_seconds):
+        now = get_utc_int()
+        return cls.objects(timestamp_lease_expires__lt=now) \
+            .order_by('priority', 'timestamp_queued') \
+            .modify(new=True, set__owner=owner, set__timestamp_lease_expires=now + lease_seconds, inc__attempts=1)
+
+    def complete(self):
+        # a task that was queued again while it was running, is kept
+        self.__class__.objects(file=self.file, revision=self.revision).delete()
+
+    def fail(self, error, retry_seconds):
+        self.__class__.objects(file=self.file, owner=self.owner).update_one(
+            set__timestamp_lease_expires=get_utc_int() + retry_seconds,
+            set__last_error=error,
+        )
@@ -0,0 +1,54 @@
+import os
+import uuid
+
+from mongoengine import Document, StringField, IntField, ReferenceField
+
+from app.models.cache import LOCAL_CACHE
+from nimbus import config
+from nimbus.helpers.timestamp import get_utc_int
+
+UPLOAD_DIR = os.path.join(LOCAL_CACHE, 'uploads')
+UPLOAD_EXPIRE_SECONDS = int(config.get('upload', 'expire_seconds'))  # uploads without new parts are removed after this
+
+os.makedirs(UPLOAD_DIR, exist_ok=True)
+
+
+class Upload(Document):
+    # a file that is uploaded in parts, the parts are appended to a staging file in the cache of the proxy worker
+    upload_id = StringField(primary_key=True, default=lambda: uuid.uuid4().hex)
+    source = ReferenceField('Hub', required=True)
+    collection = StringField(required=True)
+    filename = StringField(required=True)
+    size = IntField(required=True, default=0)  # bytes received, the next part starts here
+    timestamp_created = IntField(required=True, default=get_utc_int)
+    timestamp_updated = IntField(required=True, default=get_utc_int)
+
+    @property
+    def file_path(self):
+        return os.path.join(UPLOAD_DIR, self.upload_id)
+
+    def write_part(self, offset, data):
+        # returns False when the part doesn't start at the end of the received bytes, e.g. when it was sent before
+        if offset != self.size:
+            return False
+        with open(self.file_path, 'r+b' if os.path.exists(self.file_path) else 'wb') as f:
+            # bytes beyond size are from a part that was not registered
+            f.seek(offset)
+            f.write(data)
+            f.truncate()
+        is_registered = self.__class__.objects(upload_id=self.upload_id, size=offset) \
+            .update_one(inc__size=len(data), set__timestamp_updated=get_utc_int()) == 1
+        self.reload()
+        return is_registered
+
+    def remove(self):
+        try:
+            os.remove(self.file_path)
+        except FileNotFoundError:
+            pass
+        self.delete()
+
+    @classmethod
+    def expire(cls):
+        for upload in cls.objects(timestamp_updated__lt=get_utc_int() - UPLOAD_EXPIRE_SECONDS):
+            upload.remove()
@@ -0,0 +1,65 @@
+import uuid
+
+from mongoengine import Document, StringField, IntField, NotUniqueError
+
+from app.helpers import get_owner
+from nimbus.helpers.timestamp import get_utc_int
+
+KEYSPACE_SIZE = 16 ** 8  # ranges are split on the first 8 hex digits of the file uuids
+
+
+class VerificationRun(Document):
+    run_id = StringField(primary_key=True, default=lambda: uuid.uuid4().hex)
+    func = StringField(required=True)
+    range_index = IntField(required=True, default=0)
+    range_count = IntField(required=True, default=1)
+    cursor = StringField()  # uuid of the last verified file
+    owner = StringField(required=True)
+    timestamp_started = IntField(required=True, default=get_utc_int)
+    timestamp_heartbeat = IntField(required=True, default=get_utc_int)
+    timestamp_finished = IntField()
+    active = StringField()  # func and range while the run is unfinished, so only one of these runs can exist
+
+    meta = {
+        'indexes': [{'fields': ['active'], 'unique': True, 'sparse': True}],
+    }
+
+    @classmethod
+    def claim(cls, func, range_index, range_count, lease_seconds):
+        # continue an unfinished run when its owner has stopped, returns None when it is still running
+        owner = get_owner()
+        now = get_utc_int()
+        run = cls.objects(func=func, range_index=range_index, range_count=range_count,
+                          timestamp_finished=None).first()
+        if run is None:
+            run = cls(func=func, range_index=range_index, range_count=range_count, owner=owner,
+                      active='{}:{}/{}'.format(func, range_index, range_count))
+            try:
+                run.save(force_insert=True)
+            except NotUniqueError:
+                # another process has started the same run at the same time
+                return None
+            return run
+        return cls.objects(run_id=run.run_id, timestamp_finished=None, timestamp_heartbeat__lt=now - lease_seconds) \
+            .modify(new=True, set__owner=owner, set__timestamp_heartbeat=now)
+
+    @property
+    def bounds(self):
+        def bound(index):
+            return '{:08x}'.format(index * KEYSPACE_SIZE // self.range_count)
+
+        start = bound(self.range_index)
+        end = bound(self.range_index + 1) if self.range_index + 1 < self.range_count else None
+        return start, end
+
+    def checkpoint(self, cursor):
+        # returns False when another process has taken over the run
+        self.cursor = cursor
+        return self.__class__.objects(run_id=self.run_id, owner=self.owner) \
+            .update_one(set__cursor=cursor, set__timestamp_heartbeat=get_utc_int()) == 1
+
+    def finish(self):
+        self.timestamp_finished = get_utc_int()
+        self.active = None
+        self.__class__.objects(run_id=self.run_id, owner=self.owner) \
+            .update_one(set__timestamp_finished=self.timestamp_finished, unset__active=True)
@@ -1,3 +1,5 @@
+from bson import DBRef
+
 from nimbus.worker.serializer import Serializer
 
 from app.models.file import File
@@ -5,15 +7,20 @@ from app.models.file import File
 
 class FileSerializer(Serializer):
     MODEL = File
+    # the fragments aren't needed
+    FIELDS = ('uuid', 'timestamp_created', 'source', 'collection', 'filename', 'hash', 'size')
 
     def serialize(self):
+        source = self.object.source
         return {
             'uuid': self.object.uuid,
             'timestamp_created': self.object.timestamp_created,
-            'source': self.object.source.cumulus_id,
+            # not dereferenced when listing files
+            'source': source.id if isinstance(source, DBRef) else source.cumulus_id,
             'collection': self.object.collection,
             'name': self.object.filename,
             'hash': self.object.hash,
+            'size': self.object.size,
         }
 
 
@@ -24,3 +31,17 @@ class FileContentSerializer(FileSerializer):
         with self.object as f:
             data['content'] = f.read()
         return data
+
+
+class FileRangeSerializer(FileSerializer):
+
+    def __init__(self, file, offset, length, *args, **kwargs):
+        self._offset = offset
+        self._length = length
+        super().__init__(file, *args, **kwargs)
+
+    def serialize(self):
+        data = super().serialize()
+        data['offset'] = self._offset
+        data['content'] = self.object.read_range(self._offset, self._length)
+        return data
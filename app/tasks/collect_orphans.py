@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+import argparse
+from collections import defaultdict, Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from app.helpers import RateLimit
+from app.models.cache.fragment import batches, download_fragment_sizes, remove_fragments_content
+from app.models.error import RemoteStorageError
+from app.models.fragment import OrphanedFragment
+from app.models.hub import Hub, HUB_LOST
+from nimbus import config
+from nimbus.errors import ConnectionTimeoutError
+from nimbus.helpers.timestamp import get_utc_int
+from nimbus.log import get_logger
+
+COLLECT_GRACE_SECONDS = int(config.get('collect', 'grace_seconds'))  # orphans are kept this long before removal
+COLLECT_WORKERS = int(config.get('collect', 'workers'))  # number of storage requests at the same time
+COLLECT_RATE = int(config.get('collect', 'fragments_per_second'))  # for all workers, 0 for no limit
+COLLECT_SCAN_SIZE = 10000  # number of orphans read from mongodb at the same time
+logger = get_logger(__name__)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only report the orphans and the space they use, nothing is removed')
+    return parser.parse_args()
+
+
+def scan_orphans(timestamp_orphaned_before):
+    # raw orphan documents in pages, ordered by uuid so orphans that could not be removed are skipped
+    cursor = None
+    while True:
+        orphans = OrphanedFragment.objects(timestamp_orphaned__lt=timestamp_orphaned_before)
+        if cursor is not None:
+            orphans = orphans(uuid__gt=cursor)
+        page = list(orphans.only('uuid', 'remote', 'reason').order_by('uuid').limit(COLLECT_SCAN_SIZE).as_pymongo())
+        if not page:
+            return
+        yield page
+        cursor = page[-1]['_id']
+
+
+def remove_orphans(hub, fragment_uuids, rate_limit):
+    # returns the number of removed orphans
+    if hub is not None and hub.status != HUB_LOST:
+        rate_limit.consume(len(fragment_uuids))
+        try:
+            remove_fragments_content(hub, fragment_uuids)
+        except (RemoteStorageError, ConnectionTimeoutError):
+            logger.warning('Could not remove {} orphaned fragments from {}'.format(len(fragment_uuids), hub.cumulus_id))
+            return 0
+    # the content of orphans on hubs that don't exist or are lost can't be removed anymore
+    OrphanedFragment.objects(uuid__in=fragment_uuids).delete()
+    return len(fragment_uuids)
+
+
+def measure_orphans(hub, fragment_uuids):
+    # returns the number of bytes used by the orphans on the hub
+    if hub is None or hub.status == HUB_LOST:
+        return 0
+    try:
+        return sum(download_fragment_sizes(hub, fragment_uuids).values())
+    except (RemoteStorageError, ConnectionTimeoutError):
+        logger.warning('Could not retrieve the size of orphaned fragments from {}'.format(hub.cumulus_id))
+        return 0
+
+
+def collect_orphans(dry_run=False):
+    hubs = {hub.cumulus_id: hub for hub in Hub.objects}
+    rate_limit = RateLimit(COLLECT_RATE)
+    found = Counter()  # per hub
+    removed = Counter()  # per hub
+    reasons = Counter()
+    sizes = Counter()  # per hub, only for a dry run
+
+    with ThreadPoolExecutor(max_workers=COLLECT_WORKERS) as executor:
+        for page in scan_orphans(get_utc_int() - COLLECT_GRACE_SECONDS):
+            fragment_uuids_by_hub = defaultdict(list)
+            for orphan_document in page:
+                fragment_uuids_by_hub[orphan_document['remote']].append(orphan_document['_id'])
+                reasons[orphan_document['reason']] += 1
+
+            futures = []
+            for hub_id, fragment_uuids in fragment_uuids_by_hub.items():
+                found[hub_id] += len(fragment_uuids)
+                for batch in batches(fragment_uuids):
+                    if dry_run:
+                        futures.append((hub_id, executor.submit(measure_orphans, hubs.get(hub_id), batch)))
+                    else:
+                        futures.append((hub_id, executor.submit(remove_orphans, hubs.get(hub_id), batch, rate_limit)))
+
+            for hub_id, future in futures:
+                if dry_run:
+                    sizes[hub_id] += future.result()
+                else:
+                    removed[hub_id] += future.result()
+
+            logger.info('Orphans found: {}, removed: {}'.format(sum(found.values()), sum(removed.values())))
+
+    for hub_id in sorted(found):
+        if dry_run:
+            logger.info('{}: {} orphans, {} MB'.format(hub_id, found[hub_id], sizes[hub_id] // 1024 ** 2))
+        else:
+            logger.info('{}: {} orphans, {} removed'.format(hub_id, found[hub_id], removed[hub_id]))
+    logger.info('Orphans per reason: {}'.format(dict(reasons)))
+    return sum(found.values()), sum(removed.values())
+
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+    logger.info('Starting orphan collection{}'.format(' (dry run)' if arguments.dry_run else ''))
+    found_count, removed_count = collect_orphans(arguments.dry_run)
+    logger.info('Finished orphan collection. Found orphans: {}, removed: {}'.format(found_count, removed_count))
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+import argparse
+
+from app.models.file import File
+from app.models.fragment import OrphanedFragment
+from app.models.hub import Hub
+from app.models.reconstruction import ReconstructionTask
+from app.models.verification import VerificationRun
+from nimbus.log import get_logger
+
+DOCUMENTS = [File, OrphanedFragment, Hub, ReconstructionTask, VerificationRun]
+logger = get_logger(__name__)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--check', action='store_true',
+                        help='only report missing and extra indexes, nothing is created')
+    return parser.parse_args()
+
+
+def find_duplicate_files():
+    # these prevent the unique index on source, collection and filename
+    pipeline = [
+        {'$group': {
+            '_id': {'source': '$source', 'collection': '$collection', 'filename': '$filename'},
+            'uuids': {'$push': '$_id'},
+            'count': {'$sum': 1},
+        }},
+        {'$match': {'count': {'$gt': 1}}},
+    ]
+    return list(File.objects.aggregate(*pipeline, allowDiskUse=True))
+
+
+def check_indexes():
+    # returns True when all declared indexes exist
+    is_complete = True
+    for document in DOCUMENTS:
+        differences = document.compare_indexes()
+        for index in differences['missing']:
+            logger.info('{}: missing index {}'.format(document.__name__, index))
+            is_complete = False
+        for index in differences['extra']:
+            logger.info('{}: extra index {}'.format(document.__name__, index))
+    return is_complete
+
+
+def ensure_indexes():
+    duplicates = find_duplicate_files()
+    if duplicates:
+        for duplicate in duplicates:
+            logger.error('Duplicate files {}: {}'.format(duplicate['_id'], duplicate['uuids']))
+        logger.error('Remove the duplicate files before the indexes can be created')
+        return False
+
+    for document in DOCUMENTS:
+        logger.info('Ensuring indexes of {}'.format(document.__name__))
+        document.ensure_indexes()
+    return check_indexes()
+
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+    if arguments.check:
+        is_complete = check_indexes()
+    else:
+        is_complete = ensure_indexes()
+    logger.info('Indexes are {}'.format('complete' if is_complete else 'incomplete'))
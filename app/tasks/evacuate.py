@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from app.helpers import RateLimit
+from app.models.error import ReconstructionError, RemoteStorageError, NoRemoteStorageLocationFound
+from app.models.file import File
+from app.models.hub import Hub, HUB_DRAINING, HUB_LOST
+from app.models.reconstruction import ReconstructionTask
+from nimbus import config
+from nimbus.errors import ConnectionTimeoutError
+from nimbus.log import get_logger
+
+EVACUATE_WORKERS = int(config.get('evacuate', 'workers'))
+EVACUATE_BANDWIDTH = int(config.get('evacuate', 'bandwidth'))  # bytes per second for all workers, 0 for no limit
+EVACUATE_BATCH_SIZE = 100
+EVACUATE_RESCAN_SECONDS = 10  # wait before scanning again for fragments of uploads that were still running
+logger = get_logger(__name__)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('hub', help='cumulus id of the hub to evacuate')
+    parser.add_argument('--lost', action='store_true',
+                        help='the hub is gone for good, its fragments are not read anymore')
+    parser.add_argument('--status', action='store_true',
+                        help='only report what is left on the hub')
+    return parser.parse_args()
+
+
+def transfer_bytes(file_size, encoding, fragment_count):
+    # k fragments are downloaded and the missing ones uploaded, files stored before their size was known count as 0
+    return (file_size or 0) * (encoding['k'] + fragment_count) // encoding['k']
+
+
+def evacuate_file(file, hub, bandwidth):
+    for fragment in file.fragments:
+        if fragment.remote == hub:
+            fragment.is_clean = False
+    missing_count = len([f for f in file.fragments if not f.is_clean])
+    size = transfer_bytes(file.size, file.encoding, missing_count)
+
+    bandwidth.consume(size)
+    try:
+        file.reconstruct()
+    except (ReconstructionError, RemoteStorageError, NoRemoteStorageLocationFound, ConnectionTimeoutError) as e:
+        logger.warning('Evacuation of {} failed: {}'.format(file, repr(e)))
+        file.save()
+        ReconstructionTask.enqueue(file)
+        return False, size
+    return True, size
+
+
+def log_progress(hub, done, failed, total, transferred, started):
+    elapsed = time.monotonic() - started
+    rate = done / elapsed if elapsed else 0
+    eta = (total - done) / rate if rate else None
+    logger.info('Evacuating {}: {}/{} files, {} failed, {} MB transferred ({} MB/s), ETA {}'.format(
+        hub.cumulus_id, done, total, failed, transferred // 1024 ** 2,
+        round(transferred / 1024 ** 2 / elapsed, 1) if elapsed else 0,
+        '{} s'.format(round(eta)) if eta is not None else 'unknown'
+    ))
+
+
+def report_hub(hub):
+    files = File.objects(fragments__remote=hub.cumulus_id).only('size', 'encoding', 'fragments').as_pymongo()
+    file_count = 0
+    size = 0
+    for file_document in files:
+        fragment_count = len([f for f in file_document['fragments'] if f['remote'] == hub.cumulus_id])
+        file_count += 1
+        size += transfer_bytes(file_document.get('size'), file_document['encoding'], fragment_count)
+    logger.info('Hub {} ({}): {} files left, {} MB to transfer, ETA {}'.format(
+        hub.cumulus_id, hub.status, file_count, size // 1024 ** 2,
+        '{} s'.format(size // EVACUATE_BANDWIDTH) if EVACUATE_BANDWIDTH else 'unknown'
+    ))
+    return file_count
+
+
+def evacuate_hub(hub, status):
+    # placement skips the hub from now on, so the rebuilt fragments are spread over the other hubs
+    hub.status = status
+    hub.save()
+
+    total = File.objects(fragments__remote=hub.cumulus_id).count()
+    bandwidth = RateLimit(EVACUATE_BANDWIDTH)
+    evacuated = set()
+    failed = set()
+    transferred = 0
+    started = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=EVACUATE_WORKERS) as executor:
+        # uploads that reserved the hub before its status changed still add fragments, also behind the cursor, so
+        # the files are scanned again until a scan doesn't evacuate anything and no uploads are left
+        while True:
+            evacuated_count = 0
+            cursor = None
+            while True:
+                # evacuated files don't match anymore, the cursor skips the files that failed
+                files = File.objects(fragments__remote=hub.cumulus_id)
+                if cursor is not None:
+                    files = files(uuid__gt=cursor)
+                batch = list(files.order_by('uuid').limit(EVACUATE_BATCH_SIZE))
+                if not batch:
+                    break
+
+                results = executor.map(partial(evacuate_file, hub=hub, bandwidth=bandwidth), batch)
+                for file, (is_evacuated, size) in zip(batch, results):
+                    transferred += size
+                    if is_evacuated:
+                        evacuated.add(file.uuid)
+                        failed.discard(file.uuid)
+                        evacuated_count += 1
+                    else:
+                        failed.add(file.uuid)
+                cursor = batch[-1].uuid
+                done = len(evacuated) + len(failed)
+                log_progress(hub, done, len(failed), max(total, done), transferred, started)
+
+            hub.reload()
+            if evacuated_count == 0 and hub.reserved_bytes == 0:
+                break
+            if evacuated_count == 0:
+                time.sleep(EVACUATE_RESCAN_SECONDS)
+
+    return len(evacuated) + len(failed), len(failed)
+
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+    hub = Hub.objects(cumulus_id=arguments.hub).first()
+    if hub is None:
+        logger.error('Hub {} does not exist'.format(arguments.hub))
+    elif arguments.status:
+        report_hub(hub)
+    else:
+        logger.info('Starting evacuation of {}'.format(hub.cumulus_id))
+        done, failed = evacuate_hub(hub, HUB_LOST if arguments.lost else HUB_DRAINING)
+        logger.info('Finished evacuation of {}. Evacuated files: {}, failed: {}'.format(
+            hub.cumulus_id, done - failed, failed
+        ))
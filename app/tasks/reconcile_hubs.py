@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+from app.models.cache.fragment import download_hub_stats, store_available_bytes
+from app.models.error import RemoteStorageError
+from app.models.hub import Hub, HUB_LOST
+from nimbus.errors import ConnectionTimeoutError
+from nimbus.log import get_logger
+
+logger = get_logger(__name__)
+
+
+def reconcile_hubs():
+    # the available bytes reported by the storage workers replace the stored values
+    Hub.expire_reservations()
+    count = 0
+    for hub in Hub.objects(status__ne=HUB_LOST):
+        try:
+            stats = download_hub_stats(hub)
+        except (RemoteStorageError, ConnectionTimeoutError):
+            logger.warning('Could not retrieve stats from {}'.format(hub.cumulus_id))
+            continue
+        if stats['available_bytes'] != hub.available_bytes:
+            logger.debug('Available bytes of {}: {} -> {}'.format(
+                hub.cumulus_id, hub.available_bytes, stats['available_bytes']
+            ))
+        store_available_bytes(hub, stats['available_bytes'])
+        count += 1
+    return count
+
+
+if __name__ == '__main__':
+    logger.info('Starting hub reconciliation')
+    count = reconcile_hubs()
+    logger.info('Finished hub reconciliation. Reconciled hubs: {}'.format(count))
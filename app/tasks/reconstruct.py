@@ -1,29 +1,67 @@
 #!/usr/bin/env python3
-import os
+from concurrent.futures import ThreadPoolExecutor
 
+from app.helpers import get_owner
+from app.models.error import ReconstructionError, RemoteStorageError, NoRemoteStorageLocationFound
 from app.models.file import File
+from app.models.reconstruction import ReconstructionTask
+from nimbus import config
+from nimbus.errors import ConnectionTimeoutError
 from nimbus.log import get_logger
 
-LOCK_FILE = '/tmp/cumulus/reconstruct.lock'
+RECONSTRUCT_WORKERS = int(config.get('reconstruct', 'workers'))
+RECONSTRUCT_LEASE_SECONDS = int(config.get('reconstruct', 'lease_seconds'))
+RECONSTRUCT_RETRY_SECONDS = int(config.get('reconstruct', 'retry_seconds'))
 logger = get_logger(__name__)
 
 
-def reconstruct_files():
+def queue_unclean_files():
+    # files that were flagged without being queued
     count = 0
-    for file in File.objects(fragments__is_clean=False):
-        logger.debug('Reconstructing {}'.format(file))
-        file.reconstruct()
+    for file in File.objects(fragments__is_clean=False).only('uuid', 'encoding', 'fragments'):
+        ReconstructionTask.enqueue(file)
         count += 1
     return count
 
 
+def reconstruct_queued_files(owner):
+    count = 0
+    while True:
+        task = ReconstructionTask.lease(owner, RECONSTRUCT_LEASE_SECONDS)
+        if task is None:
+            return count
+
+        file = File.objects(uuid=task.file).first()
+        if file is None:
+            task.complete()
+            continue
+
+        logger.debug('Reconstructing {} (priority {}, attempt {})'.format(file, task.priority, task.attempts))
+        try:
+            file.reconstruct()
+        except (ReconstructionError, RemoteStorageError, NoRemoteStorageLocationFound, ConnectionTimeoutError) as e:
+            logger.warning('Reconstruction of {} failed: {}'.format(file, repr(e)))
+            task.fail(repr(e), RECONSTRUCT_RETRY_SECONDS * task.attempts)
+            continue
+
+        task.complete()
+        if not all(fragment.is_clean for fragment in file.fragments):
+            ReconstructionTask.enqueue(file)
+        count += 1
+
+
+def reconstruct_files():
+    queue_unclean_files()
+    owner = get_owner()
+    with ThreadPoolExecutor(max_workers=RECONSTRUCT_WORKERS) as executor:
+        futures = [
+            executor.submit(reconstruct_queued_files, '{}:{}'.format(owner, i))
+            for i in range(RECONSTRUCT_WORKERS)
+        ]
+    return sum(future.result() for future in futures)
+
+
 if __name__ == '__main__':
-    os.makedirs(os.path.dirname(LOCK_FILE), exist_ok=True)
-    if not os.path.exists(LOCK_FILE):
-        logger.info('Starting file reconstruction')
-        open(LOCK_FILE, 'wb').close()
-        count = reconstruct_files()
-        os.remove(LOCK_FILE)
-        logger.info('Finished file reconstruction. Reconstructed files: {}'.format(count))
-    else:
-        logger.info('Another file reconstruction is running, aborting...')
+    logger.info('Starting file reconstruction')
+    count = reconstruct_files()
+    logger.info('Finished file reconstruction. Reconstructed files: {}'.format(count))
@@ -1,44 +1,225 @@
-from app.helpers import one
+import argparse
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo import UpdateOne
+
+from app.models.cache.fragment import download_fragment_hashes
+from app.models.error import RemoteStorageError
 from app.models.file import File
+from app.models.hub import Hub
+from app.models.reconstruction import ReconstructionTask
+from app.models.verification import VerificationRun
 from nimbus import config
+from nimbus.errors import ConnectionTimeoutError
 from nimbus.log import get_logger
 
 logger = get_logger(__name__)
 
 VERIFY_FRACTION = float(config.get('verify', 'fraction'))
+VERIFY_WORKERS = int(config.get('verify', 'workers'))  # number of hubs queried at the same time
+VERIFY_BATCH_SIZE = int(config.get('verify', 'batch_size'))  # number of files verified at the same time
+VERIFY_LEASE_SECONDS = int(config.get('verify', 'lease_seconds'))  # a run without progress for this long is resumed
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--range', default='0/1',
+                        help='part of the files to verify as index/count, e.g. 0/4 up to 3/4 for four processes')
+    arguments = parser.parse_args()
+    range_index, range_count = (int(i) for i in arguments.range.split('/'))
+    return {'range_index': range_index, 'range_count': range_count}
+
+
+def parse_random_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--per-hub', action='store_true',
+                        help='take an equal share of the sample from the files on every hub')
+    arguments = parser.parse_args()
+    return {'per_hub': arguments.per_hub}
+
+
+def start_run(func, range_index, range_count):
+    run = VerificationRun.claim(func, range_index, range_count, VERIFY_LEASE_SECONDS)
+    if run is None:
+        logger.info('Another verification of range {}/{} is running, aborting...'.format(range_index, range_count))
+    elif run.cursor is not None:
+        logger.info('Resuming verification run {} after file {}'.format(run.run_id, run.cursor))
+    return run
+
+
+def download_hashes(hub, fragment_uuids):
+    # None when the hashes are unknown because the hub could not be reached
+    if hub is None:
+        # the hub doesn't exist anymore, so its fragments are lost
+        return dict.fromkeys(fragment_uuids, '')
+    try:
+        return download_fragment_hashes(hub, fragment_uuids)
+    except (RemoteStorageError, ConnectionTimeoutError):
+        logger.warning('Could not retrieve fragment hashes from {}'.format(hub.cumulus_id))
+        return None
+
+
+def verify_hashes(file_documents, hubs):
+    # file_documents are raw documents, their fragments are grouped by hub and all hubs are queried in parallel
+    fragments_by_hub = defaultdict(list)
+    for file_document in file_documents:
+        for fragment in file_document['fragments']:
+            fragments_by_hub[fragment['remote']].append((file_document['_id'], fragment))
+
+    with ThreadPoolExecutor(max_workers=VERIFY_WORKERS) as executor:
+        futures = {
+            hub_id: executor.submit(download_hashes, hubs.get(hub_id), [fragment['_id'] for _, fragment in fragments])
+            for hub_id, fragments in fragments_by_hub.items()
+        }
+
+    failed_files = set()
+    updates = []
+    for hub_id, fragments in fragments_by_hub.items():
+        hashes = futures[hub_id].result()
+        if hashes is None:
+            # a hub that can't be reached doesn't change the state of its fragments
+            continue
+        for file_uuid, fragment in fragments:
+            if fragment['_id'] not in hashes:
+                # the hub hasn't hashed this fragment yet
+                continue
+            # a matching hash only says the stored hash is right, not the content: a fragment that failed while
+            # reading stays unclean until it is reconstructed or verify_full has read its content
+            if not fragment.get('is_clean', True):
+                failed_files.add(file_uuid)
+            elif hashes[fragment['_id']] != fragment['hash']:
+                failed_files.add(file_uuid)
+                updates.append(UpdateOne(
+                    {'_id': file_uuid, 'fragments._id': fragment['_id']},
+                    {'$set': {'fragments.$.is_clean': False}}
+                ))
+                fragment['is_clean'] = False
+
+    if updates:
+        File._get_collection().bulk_write(updates, ordered=False)
+    return failed_files
+
+
+def scan_files(run, fields=None, batch_size=VERIFY_BATCH_SIZE):
+    # raw file documents of the range of the run in batches, ordered by uuid and continuing after the cursor of the
+    # run, so no database cursor has to stay open while a batch is verified
+    start, end = run.bounds
+    while True:
+        if run.cursor is not None:
+            files = File.objects(uuid__gt=run.cursor)
+        else:
+            files = File.objects(uuid__gte=start)
+        if end is not None:
+            files = files(uuid__lt=end)
+        if fields is not None:
+            files = files.only(*fields)
+        batch = list(files.order_by('uuid').limit(batch_size).as_pymongo())
+        if not batch:
+            run.finish()
+            return
+        yield batch
+        if not run.checkpoint(batch[-1]['_id']):
+            logger.warning('Verification run {} was taken over by another process'.format(run.run_id))
+            return
 
 
-def v_all(func):
+def v_all_hashes(range_index=0, range_count=1):
+    run = start_run('verify_hash', range_index, range_count)
+    if run is None:
+        return
+
+    hubs = {hub.cumulus_id: hub for hub in Hub.objects}
     files_to_reconstruct = list()
+    file_count = 0
+    fragment_count = 0
+    start = time.perf_counter()
+
+    # the encoding is needed to queue failed files for reconstruction
+    fields = ['uuid', 'source', 'collection', 'filename', 'encoding', 'fragments']
+    for file_documents in scan_files(run, fields=fields):
+        failed_files = verify_hashes(file_documents, hubs)
+        for file_document in file_documents:
+            if file_document['_id'] in failed_files:
+                files_to_reconstruct.append(file_document['_id'])
+                ReconstructionTask.enqueue(File._from_son(file_document))
+                logger.debug('{} check failed: {}: {}/{}/{}'.format(
+                    'verify_hash', file_document['_id'], file_document['source'],
+                    file_document['collection'], file_document['filename']
+                ))
+
+        file_count += len(file_documents)
+        fragment_count += sum(len(file_document['fragments']) for file_document in file_documents)
+        elapsed = time.perf_counter() - start
+        logger.info('Verified {} files, {} fragments in {} s ({} fragments/s)'.format(
+            file_count, fragment_count, round(elapsed, 1), round(fragment_count / elapsed)
+        ))
+
+    logger.info('Files to reconstruct: {}'.format(len(files_to_reconstruct)))
 
-    for file in File.objects:
-        if not getattr(file, func)():
-            files_to_reconstruct.append(file.uuid)
-            logger.debug('{} check failed: {}: {}/{}/{}'.format(
-                func, file.uuid, file.source.cumulus_id, file.collection, file.filename
-            ))
+
+def v_all(func, range_index=0, range_count=1):
+    run = start_run(func, range_index, range_count)
+    if run is None:
+        return
+
+    files_to_reconstruct = list()
+
+    for file_documents in scan_files(run):
+        for file_document in file_documents:
+            file = File._from_son(file_document)
+            if not getattr(file, func)():
+                files_to_reconstruct.append(file.uuid)
+                ReconstructionTask.enqueue(file)
+                logger.debug('{} check failed: {}: {}/{}/{}'.format(
+                    func, file.uuid, file.source.cumulus_id, file.collection, file.filename
+                ))
 
     logger.info('Files to reconstruct: {}'.format(len(files_to_reconstruct)))
 
-    # for file_uuid in files_to_reconstruct:
-    #     file = one(File.objects(uuid=file_uuid))
-    #     file.reconstruct()
 
+def sample_files(per_hub=False):
+    # raw documents of a random sample of the files, without counting all files
+    sample_size = int(File._get_collection().estimated_document_count() * VERIFY_FRACTION)
+    if sample_size == 0:
+        return []
+    if not per_hub:
+        return list(File.objects.aggregate(*[{'$sample': {'size': sample_size}}]))
 
-def v_random(func):
-    pipeline = [{'$sample': {'size': int(len(File.objects) * VERIFY_FRACTION)}}]
+    # every hub gets an equal share of the sample, so small hubs are verified as often as large ones
+    hub_ids = [hub.cumulus_id for hub in Hub.objects.only('cumulus_id')]
+    hub_sample_size = max(1, sample_size // max(1, len(hub_ids)))
+    file_documents = {}
+    for hub_id in hub_ids:
+        pipeline = [
+            {'$match': {'fragments.remote': hub_id}},
+            {'$sample': {'size': hub_sample_size}},
+        ]
+        for file_document in File.objects.aggregate(*pipeline):
+            file_documents[file_document['_id']] = file_document
+    return list(file_documents.values())
+
+
+def v_random(func, per_hub=False):
+    file_documents = sample_files(per_hub)
     files_to_reconstruct = list()
 
-    for file_dict in File.objects.aggregate(*pipeline):
-        file = one(File.objects(uuid=file_dict['uuid']))
-        if not getattr(file, func)():
+    if func == 'verify_hash':
+        hubs = {hub.cumulus_id: hub for hub in Hub.objects}
+        failed_files = verify_hashes(file_documents, hubs)
+    else:
+        failed_files = set()
+
+    for file_document in file_documents:
+        file = File._from_son(file_document)
+        if func != 'verify_hash' and not getattr(file, func)():
+            failed_files.add(file.uuid)
+        if file.uuid in failed_files:
             files_to_reconstruct.append(file.uuid)
+            ReconstructionTask.enqueue(file)
             logger.debug('{} check failed: {}: {}/{}/{}'.format(
-                func, file.uid, file.source, file.collection, file.filename
+                func, file.uuid, file_document['source'], file.collection, file.filename
             ))
 
     logger.info('Files to reconstruct: {}'.format(len(files_to_reconstruct)))
-
-    # for file_uuid in files_to_reconstruct:
-    #     file = one(File.objects(uuid=file_uuid))
-    #     file.reconstruct()
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-from app.tasks.verify import v_all
+from app.tasks.verify import v_all, parse_arguments
 
 func = 'verify_full'
-v_all(func)
+v_all(func, **parse_arguments())
@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 
-from app.tasks.verify import v_all
+from app.tasks.verify import v_all_hashes, parse_arguments
 
-func = 'verify_hash'
-v_all(func)
+v_all_hashes(**parse_arguments())
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-from app.tasks.verify import v_random
+from app.tasks.verify import v_random, parse_random_arguments
 
 func = 'verify_hash'
-v_random(func)
+v_random(func, **parse_random_arguments())
@@ -1,8 +1,12 @@
+import os
+
+import requests
 from mongoengine import Q
 
 from app.models.file import File, Encoding
 from app.models.hub import Hub
-from app.serializers import FileSerializer, FileContentSerializer
+from app.models.upload import Upload
+from app.serializers import FileSerializer, FileContentSerializer, FileRangeSerializer
 from nimbus.worker.context import ctx_request
 from nimbus.worker.errors import MultipleObjectsFound, ObjectDoesNotExist
 
@@ -10,40 +14,86 @@ DEFAULT_ENCODING = {
     'name': 'liberasurecode_rs_vand',
     'k': 2,
     'm': 3,
+    'stripe_size': 4 * 1024 * 1024,
 }
 
+LIST_LIMIT = 1000  # number of files per page when no limit is given
+LIST_MAX_LIMIT = 10000
+
+
+def get_int_parameter(parameters, name, default=None, minimum=None):
+    # raises ValueError when the parameter is missing without a default, not a number or below the minimum
+    if name not in parameters:
+        if default is None:
+            raise ValueError('The {} is required'.format(name))
+        return default
+    try:
+        value = int(parameters[name])
+    except (TypeError, ValueError):
+        raise ValueError('The {} must be a number'.format(name))
+    if minimum is not None and value < minimum:
+        raise ValueError('The {} must be at least {}'.format(name, minimum))
+    return value
+
+
+def bad_request(message):
+    return {'error': message}, requests.codes.bad_request
+
 
 @ctx_request.route('file', methods=['LIST'])
 def list_files(request):
+    # files are ordered by uuid, the next page starts after the uuid of the last file of the previous page (cursor)
     files = File.objects
     if 'source' in request.parameters:
         files = files(source=request.parameters['source'])
+    if 'collection_prefix' in request.parameters:
+        files = files(collection__startswith=request.parameters['collection_prefix'])
+    if 'name_prefix' in request.parameters:
+        files = files(filename__startswith=request.parameters['name_prefix'])
+    if 'cursor' in request.parameters:
+        files = files(uuid__gt=request.parameters['cursor'])
+    try:
+        limit = get_int_parameter(request.parameters, 'limit', default=LIST_LIMIT)
+    except ValueError as e:
+        return bad_request(str(e))
+    # a limit of 0 would return all files
+    limit = max(1, min(limit, LIST_MAX_LIMIT))
+    files = files.only(*FileSerializer.FIELDS).no_dereference().order_by('uuid').limit(limit)
     return FileSerializer(files, list_allowed=True).data
 
 
+def find_file(parameters):
+    # the unique index allows one file at most, the limit of 2 still detects duplicates from before the index existed
+    files = list(File.objects(Q(source=parameters['source']) &
+                              Q(collection=parameters['collection']) &
+                              Q(filename=parameters['name'])).limit(2))
+    if len(files) > 1:
+        raise MultipleObjectsFound('Multiple files found for the search query')
+    return files[0] if files else None
+
+
+def find_source(source):
+    hub = Hub.objects(cumulus_id=source).first()
+    if hub is None:
+        raise ObjectDoesNotExist('Source does not exist')
+    return hub
+
+
+def find_or_create_file(parameters):
+    file = find_file(parameters)
+    if file is None:
+        file = File()
+        file.collection = parameters['collection']
+        file.filename = parameters['name']
+        file.encoding = Encoding(**DEFAULT_ENCODING)
+        file.source = find_source(parameters['source'])
+    return file
+
+
 @ctx_request.route('file', methods=['POST'],
                    parameters=['source', 'collection', 'name'])
 def post_file(request):
-    files = File.objects(Q(source=request.parameters['source']) &
-                         Q(collection=request.parameters['collection']) &
-                         Q(filename=request.parameters['name'])).all()
-    if len(files) == 0:
-        file = File()
-        file.collection = request.parameters['collection']
-        file.filename = request.parameters['name']
-        file.encoding = Encoding(**DEFAULT_ENCODING)
-        hubs = Hub.objects(cumulus_id=request.parameters['source'])
-        if len(hubs) == 0:
-            raise ObjectDoesNotExist('Source does not exist')
-        elif len(hubs) == 1:
-            hub = hubs[0]
-        else:
-            raise MultipleObjectsFound('Multiple files found for source')
-        file.source = hub
-    elif len(files) == 1:
-        file = files[0]
-    else:
-        raise MultipleObjectsFound('Multiple objects found for the search query')
+    file = find_or_create_file(request.parameters)
 
     with file as f:
         f.write(request.data)
@@ -54,14 +104,94 @@ def post_file(request):
 @ctx_request.route('file', methods=['GET'],
                    parameters=['source', 'collection', 'name'])
 def get_file(request):
-    files = File.objects(Q(source=request.parameters['source']) &
-                         Q(collection=request.parameters['collection']) &
-                         Q(filename=request.parameters['name'])).all()
-    if len(files) == 0:
+    # with offset and/or length only that part of the file is returned, large files can be read in parts this way
+    file = find_file(request.parameters)
+    if file is None:
         raise ObjectDoesNotExist('File does not exist')
-    elif len(files) == 1:
-        file = files[0]
-    else:
-        raise MultipleObjectsFound('Multiple files found for the search query')
 
+    if 'offset' in request.parameters or 'length' in request.parameters:
+        try:
+            offset = get_int_parameter(request.parameters, 'offset', default=0, minimum=0)
+            # to the end of the file by default
+            length = get_int_parameter(request.parameters, 'length', default=-1, minimum=-1)
+        except ValueError as e:
+            return bad_request(str(e))
+        return FileRangeSerializer(file, offset, length).data
     return FileContentSerializer(file).data
+
+
+def find_upload(upload_id):
+    upload = Upload.objects(upload_id=upload_id).first()
+    if upload is None:
+        raise ObjectDoesNotExist('Upload does not exist')
+    return upload
+
+
+def serialize_upload(upload):
+    return {
+        'upload': upload.upload_id,
+        'source': upload.source.cumulus_id,
+        'collection': upload.collection,
+        'name': upload.filename,
+        'size': upload.size,
+    }
+
+
+@ctx_request.route('upload', methods=['POST'],
+                   parameters=['source', 'collection', 'name'])
+def initiate_upload(request):
+    # large files are uploaded in parts: initiate, send the parts in order, complete
+    Upload.expire()
+    upload = Upload(source=find_source(request.parameters['source']),
+                    collection=request.parameters['collection'],
+                    filename=request.parameters['name'])
+    upload.save()
+    return serialize_upload(upload)
+
+
+@ctx_request.route('upload', methods=['GET'],
+                   parameters=['upload'])
+def get_upload(request):
+    # after a dropped connection the upload continues with the part that starts at size
+    return serialize_upload(find_upload(request.parameters['upload']))
+
+
+@ctx_request.route('upload/part', methods=['POST'],
+                   parameters=['upload', 'offset'])
+def post_upload_part(request):
+    # a part that doesn't start at size is ignored, the returned size tells the client where to continue
+    try:
+        offset = get_int_parameter(request.parameters, 'offset', minimum=0)
+    except ValueError as e:
+        return bad_request(str(e))
+    upload = find_upload(request.parameters['upload'])
+    upload.write_part(offset, request.data)
+    return serialize_upload(upload)
+
+
+@ctx_request.route('upload/complete', methods=['POST'],
+                   parameters=['upload'])
+def complete_upload(request):
+    upload = find_upload(request.parameters['upload'])
+    file = find_or_create_file(serialize_upload(upload))
+
+    if not os.path.exists(upload.file_path):
+        # no parts were sent
+        open(upload.file_path, 'wb').close()
+    if not file.encoding.stripe_size:
+        # encoding the file as a whole would read the upload into memory, so the file is stored in stripes from now on
+        file.encoding = Encoding(**DEFAULT_ENCODING)
+        file.hash = None  # the fragments are replaced, also when the content didn't change
+    with file as f:
+        f.write_file(upload.file_path)
+    upload.remove()
+
+    return FileSerializer(file).data
+
+
+@ctx_request.route('upload', methods=['DELETE'],
+                   parameters=['upload'])
+def abort_upload(request):
+    upload = find_upload(request.parameters['upload'])
+    upload.remove()
+    return serialize_upload(upload)
@@ -12,6 +12,7 @@ from jinja2 import Template
 from app.models.file import File
 from app.models.fragment import OrphanedFragment
 from app.models.hub import Hub
+from app.tasks.ensure_indexes import ensure_indexes
 
 CLUSTER_DIR = 'cluster'
 NUM_STORAGE_WORKERS = 5
@@ -48,6 +49,9 @@ for hub in Hub.objects:
 # prepare new #
 ###############
 
+# create the indexes that are not created automatically
+ensure_indexes()
+
 # create new hubs
 new_hubs = []
 for reference in range(NUM_STORAGE_WORKERS + int(NUM_STORAGE_WORKERS * 0.4)):
@@ -113,6 +117,8 @@ for i in range(NUM_STORAGE_WORKERS):
         config.write(ofile)
     shutil.copy('storage_worker.py',
                 os.path.join(CLUSTER_DIR, storage_worker_dir, 'storage_worker.py'))
+    shutil.copy('storage_migrate.py',
+                os.path.join(CLUSTER_DIR, storage_worker_dir, 'storage_migrate.py'))
 
     # connection certificates
     zmq.auth.create_certificates(os.path.join(CLUSTER_DIR, storage_worker_dir, 'keys/connection-private'),
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+# Moves fragments from the flat storage layout to the sharded one. The storage worker can keep running meanwhile.
+import os
+
+from nimbus.log import get_logger
+from storage_worker import STORAGE_DIR, TMP_SUFFIX, get_file_path
+
+logger = get_logger(__name__)
+
+
+def migrate():
+    count = 0
+    with os.scandir(STORAGE_DIR) as entries:
+        for entry in entries:
+            if not entry.is_file() or entry.name.endswith(TMP_SUFFIX):
+                continue
+            file_path = get_file_path(entry.name)
+            if file_path == entry.path:
+                continue
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            try:
+                # never overwrite: a fragment at the sharded path was written after the one in the flat layout
+                os.link(entry.path, file_path)
+            except FileExistsError:
+                pass
+            os.remove(entry.path)
+            count += 1
+    return count
+
+
+if __name__ == '__main__':
+    logger.info('Starting storage migration')
+    count = migrate()
+    logger.info('Finished storage migration. Moved files: {}'.format(count))
@@ -1,5 +1,7 @@
 import os
 import shutil
+import threading
+import time
 
 import requests
 from Crypto.Hash import SHA3_256
@@ -11,41 +13,219 @@ from nimbus.worker.worker import Worker
 STORAGE_DIR = 'cache/storage'
 MINIMUM_FREE_MB = 128
 MINIMUM_FREE_RATIO = 0.01
+BATCH_MAX_BYTES = 64 * 1024 * 1024  # default limit on the content returned by one multi-get
+BATCH_MAX_SECONDS = 2  # default limit on the time spent on one multi-get, well below the request timeout
 IDENTITY = config.get('storage', 'identity')
+SHARD_LEVELS = int(config.get('storage', 'shard_levels'))
+SHARD_WIDTH = 2
+FSYNC = config.get('storage', 'fsync').lower() in ('1', 'true', 'yes', 'on')
+HASH_SUFFIX = '.sha3'  # the hash of a fragment is stored next to it
+TMP_SUFFIX = '.tmp'
+PART_SUFFIX = '.part' + TMP_SUFFIX
+PART_MAX_SECONDS = 24 * 3600  # a fragment staged in segments that is older was abandoned by its upload
+
+stored_bytes = None  # running total of the bytes in STORAGE_DIR, counted once at start up
+staged_bytes = {}  # bytes counted in stored_bytes per fragment that is staged in segments
+# held while fragments are written or removed, so a hash computed in the background is never stored for old content
+storage_lock = threading.Lock()
 
 os.makedirs(STORAGE_DIR, exist_ok=True)
 
 
-def read_file_with_chunks(file_path, chunk_size):
-    with open(file_path, 'rb') as f:
-        while True:
-            chunk = f.read(chunk_size)
-            if chunk:
-                yield chunk
-            else:
-                break
+def read_file_with_chunks(f, chunk_size):
+    while True:
+        chunk = f.read(chunk_size)
+        if chunk:
+            yield chunk
+        else:
+            break
 
 
-def get_hash(file_path):
+def get_hash(f):
     chunk_size = 1024 * 1024
     hasher = SHA3_256.new()
-    for chunk in read_file_with_chunks(file_path, chunk_size):
+    for chunk in read_file_with_chunks(f, chunk_size):
         hasher.update(chunk)
     return hasher.hexdigest()
 
 
-def get_file_path(uuid):
-    return os.path.join(STORAGE_DIR, uuid)
+def get_part_path(file_path):
+    # a fragment that is written in segments is staged here until the last segment arrives
+    return file_path + PART_SUFFIX
 
 
-def get_stored_bytes():
-    stored_bytes = 0
+def replace_file(tmp_path, file_path):
+    if FSYNC:
+        with open(tmp_path, 'rb+') as f:
+            os.fsync(f.fileno())
+    os.replace(tmp_path, file_path)
+    if FSYNC:
+        dir_fd = os.open(os.path.dirname(file_path), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+def write_file(file_path, content):
+    # write to a temporary file first, so the file is never partially written
+    tmp_path = file_path + TMP_SUFFIX
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+    replace_file(tmp_path, file_path)
+
+
+def remove_file(file_path):
+    try:
+        os.remove(file_path)
+    except FileNotFoundError:
+        pass
+
+
+def read_hash(uuid):
+    # None when the hash is not stored yet, store_missing_hashes computes it in the background
+    # raises FileNotFoundError when the fragment doesn't exist, also when its hash is still stored
+    open_file(uuid).close()
+    try:
+        with open(get_file_path(uuid) + HASH_SUFFIX, 'r') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def store_hash(uuid, file_hash, stat, replace=False):
+    # stat is of the fragment that was hashed, nothing is stored when it has been replaced or removed since then
+    hash_path = get_file_path(uuid) + HASH_SUFFIX
+    with storage_lock:
+        try:
+            with open_file(uuid) as f:
+                current_stat = os.fstat(f.fileno())
+        except FileNotFoundError:
+            return False
+        if (current_stat.st_ino, current_stat.st_mtime_ns) != (stat.st_ino, stat.st_mtime_ns):
+            return False
+        if replace or not os.path.exists(hash_path):
+            os.makedirs(os.path.dirname(hash_path), exist_ok=True)
+            write_file(hash_path, file_hash.encode())
+    return True
+
+
+def compute_hash(uuid, replace=False):
+    # with replace, a stored hash that doesn't match the content anymore is corrected
+    with open_file(uuid) as f:
+        stat = os.fstat(f.fileno())
+        file_hash = get_hash(f)
+    if not store_hash(uuid, file_hash, stat, replace):
+        return None
+    return file_hash
+
+
+def check_hash(uuid, f, content):
+    # called after the whole fragment is read: when its content has changed on disk, the stored hash is corrected so
+    # hash verification detects it
+    stat = os.fstat(f.fileno())
+    if len(content) != stat.st_size:
+        return
+    file_hash = SHA3_256.new(content).hexdigest()
+    try:
+        stored_hash = read_hash(uuid)
+    except FileNotFoundError:
+        return
+    if stored_hash is not None and stored_hash != file_hash:
+        store_hash(uuid, file_hash, stat, replace=True)
+
+
+def store_missing_hashes():
+    # fragments stored before hashes were written have no hash yet, these are hashed once at start up
+    for dirpath, dirnames, filenames in os.walk(STORAGE_DIR):
+        for filename in filenames:
+            if filename.endswith((HASH_SUFFIX, TMP_SUFFIX)):
+                continue
+            if os.path.exists(get_file_path(filename) + HASH_SUFFIX):
+                continue
+            try:
+                compute_hash(filename)
+            except FileNotFoundError:
+                pass
+
+
+def get_file_path(name):
+    # e.g. cache/storage/ab/cd/abcd..., so directories stay small when the node fills up
+    shards = [name[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH] for i in range(SHARD_LEVELS)]
+    return os.path.join(STORAGE_DIR, *shards, name)
+
+
+def get_flat_file_path(name):
+    # layout before sharding, used until storage_migrate.py has moved the fragment
+    return os.path.join(STORAGE_DIR, name)
+
+
+def open_file(uuid):
+    # the fragment may be moved to its sharded path while we look for it
+    for file_path in [get_file_path(uuid), get_flat_file_path(uuid), get_file_path(uuid)]:
+        try:
+            return open(file_path, 'rb')
+        except FileNotFoundError:
+            pass
+    raise FileNotFoundError(uuid)
+
+
+def get_file_size(file_path):
+    try:
+        return os.path.getsize(file_path)
+    except FileNotFoundError:
+        return 0
+
+
+def find_file_size(uuid):
+    try:
+        with open_file(uuid) as f:
+            return os.fstat(f.fileno()).st_size
+    except FileNotFoundError:
+        return None
+
+
+def count_stored_bytes():
+    # fragments that are staged in segments count as well, abandoned ones are removed
+    total = 0
+    now = time.time()
     for dirpath, dirnames, filenames in os.walk(STORAGE_DIR):
         for filename in filenames:
-            stored_bytes += os.path.getsize(os.path.join(dirpath, filename))
+            file_path = os.path.join(dirpath, filename)
+            if filename.endswith(PART_SUFFIX) and os.path.getmtime(file_path) < now - PART_MAX_SECONDS:
+                remove_file(file_path)
+                continue
+            if filename.endswith(HASH_SUFFIX) or \
+                    (filename.endswith(TMP_SUFFIX) and not filename.endswith(PART_SUFFIX)):
+                continue
+            total += os.path.getsize(file_path)
+    return total
+
+
+def get_stored_bytes():
+    global stored_bytes
+    if stored_bytes is None:
+        stored_bytes = count_stored_bytes()
     return stored_bytes
 
 
+def update_stored_bytes(difference):
+    global stored_bytes
+    stored_bytes = get_stored_bytes() + difference
+
+
+def remove_flat_file(uuid, file_path):
+    flat_file_path = get_flat_file_path(uuid)
+    if flat_file_path == file_path:
+        return 0
+    file_size = get_file_size(flat_file_path)
+    try:
+        os.remove(flat_file_path)
+    except FileNotFoundError:
+        return 0
+    return file_size
+
+
 def get_available_bytes():
     stored_bytes = get_stored_bytes()
 
@@ -59,29 +239,76 @@ def get_available_bytes():
     return available_bytes
 
 
+def write_segment(uuid, file_path, offset, content, size):
+    # returns the status code of the request, size is of the whole fragment: it is counted as stored as soon as the
+    # first segment arrives, so concurrent uploads can't take more than the available bytes together
+    part_path = get_part_path(file_path)
+    with storage_lock:
+        if offset == 0:
+            update_stored_bytes(-staged_bytes.pop(uuid, get_file_size(part_path)))
+            counted = 0
+        elif get_file_size(part_path) != offset:
+            # the previous segments are missing, e.g. because the worker restarted in between
+            return requests.codes.not_found
+        else:
+            # after a restart, the staged segments are counted by count_stored_bytes
+            counted = staged_bytes.get(uuid, offset)
+        reserved = max(counted, size, offset + len(content))
+        if get_available_bytes() <= reserved - counted:
+            if offset == 0:
+                remove_file(part_path)
+            return requests.codes.forbidden
+
+        if offset == 0:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(part_path, 'wb' if offset == 0 else 'ab') as f:
+            f.write(content)
+        staged_bytes[uuid] = reserved
+        update_stored_bytes(reserved - counted)
+    return requests.codes.ok
+
+
 @ctx_request.route(IDENTITY + '/file', methods=['POST'])
 def create_file(request):
     uuid = request.data[b'uuid'].decode()
     content = request.data[b'content']
+    offset = request.data.get(b'offset')
+    is_last = request.data.get(b'is_last', True)
+    size = request.data.get(b'size', len(content))  # of the whole fragment when it is sent in segments
     file_path = get_file_path(uuid)
+    hash_path = file_path + HASH_SUFFIX
 
-    available_bytes = get_available_bytes()
-
-    if available_bytes > len(content):
-        with open(file_path, 'wb') as f:
-            f.write(content)
-        file_hash = get_hash(file_path)
-        status_code = requests.codes.ok
-        available_bytes -= len(content)
+    if offset is None:
+        status_code = requests.codes.ok if get_available_bytes() > len(content) else requests.codes.forbidden
+    else:
+        status_code = write_segment(uuid, file_path, offset, content, size)
+
+    if status_code == requests.codes.ok and (offset is None or is_last):
+        with storage_lock:
+            previous_size = get_file_size(file_path)
+            remove_file(hash_path)
+            if offset is None:
+                file_hash = SHA3_256.new(content).hexdigest()
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                write_file(file_path, content)
+            else:
+                part_path = get_part_path(file_path)
+                previous_size += staged_bytes.pop(uuid, get_file_size(part_path))
+                with open(part_path, 'rb') as f:
+                    file_hash = get_hash(f)
+                replace_file(part_path, file_path)
+            write_file(hash_path, file_hash.encode())
+            previous_size += remove_flat_file(uuid, file_path)
+            update_stored_bytes(get_file_size(file_path) - previous_size)
     else:
+        # segment of a large fragment: the fragment is only stored when all segments are written
         file_hash = ''
-        status_code = requests.codes.forbidden
 
     return (
         {
             'uuid': uuid,
             'hash': file_hash,
-            'available_bytes': available_bytes
+            'available_bytes': get_available_bytes()
         },
         status_code
     )
@@ -90,15 +317,23 @@ def create_file(request):
 @ctx_request.route(IDENTITY + '/file', methods=['GET'], parameters=['uuid'])
 def retrieve_file(request):
     uuid = request.parameters['uuid']
-    file_path = get_file_path(uuid)
+    offset = request.parameters.get('offset', 0)
+    length = request.parameters.get('length', -1)
 
-    try:
-        with open(file_path, 'rb') as f:
-            content = f.read()
-        status_code = requests.codes.ok
-    except FileNotFoundError:
+    if offset < 0 or length < -1:
         content = ''
-        status_code = requests.codes.not_found
+        status_code = requests.codes.bad_request
+    else:
+        try:
+            with open_file(uuid) as f:
+                f.seek(offset)
+                content = f.read(length)
+                if offset == 0:
+                    check_hash(uuid, f, content)
+            status_code = requests.codes.ok
+        except FileNotFoundError:
+            content = ''
+            status_code = requests.codes.not_found
 
     return (
         {
@@ -111,11 +346,14 @@ def retrieve_file(request):
 
 @ctx_request.route(IDENTITY + '/hash', methods=['GET'], parameters=['uuid'])
 def retrieve_hash(request):
+    # with verify, the hash is computed from the content and the stored hash is corrected when it differs
     uuid = request.parameters['uuid']
-    file_path = get_file_path(uuid)
+    verify = request.parameters.get('verify', False)
 
     try:
-        file_hash = get_hash(file_path)
+        file_hash = None if verify else read_hash(uuid)
+        if file_hash is None:
+            file_hash = compute_hash(uuid, replace=verify) or ''
         status_code = requests.codes.ok
     except FileNotFoundError:
         file_hash = ''
@@ -130,15 +368,23 @@ def retrieve_hash(request):
     )
 
 
+def remove_fragment(uuid):
+    file_path = get_file_path(uuid)
+    with storage_lock:
+        file_size = get_file_size(file_path)
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            file_size = 0
+        remove_file(file_path + HASH_SUFFIX)
+        file_size += remove_flat_file(uuid, file_path)
+        update_stored_bytes(-file_size)
+
+
 @ctx_request.route(IDENTITY + '/file', methods=['DELETE'], parameters=['uuid'])
 def delete_file(request):
     uuid = request.parameters['uuid']
-    file_path = get_file_path(uuid)
-
-    try:
-        os.remove(file_path)
-    except FileNotFoundError:
-        pass
+    remove_fragment(uuid)
 
     return {
         'uuid': uuid,
@@ -146,6 +392,94 @@ def delete_file(request):
     }
 
 
+@ctx_request.route(IDENTITY + '/files', methods=['LIST'], parameters=['uuids'])
+def list_files(request):
+    sizes = {}
+    for uuid in request.parameters['uuids']:
+        file_size = find_file_size(uuid)
+        if file_size is not None:
+            sizes[uuid] = file_size
+
+    return {
+        'sizes': sizes,
+    }
+
+
+@ctx_request.route(IDENTITY + '/files', methods=['GET'], parameters=['uuids'])
+def retrieve_files(request):
+    uuids = request.parameters['uuids']
+    max_bytes = request.parameters.get('max_bytes', BATCH_MAX_BYTES)
+
+    contents = {}
+    missing = []
+    remaining = []
+    total_bytes = 0
+    for i, uuid in enumerate(uuids):
+        try:
+            with open_file(uuid) as f:
+                file_size = os.fstat(f.fileno()).st_size
+                if contents and total_bytes + file_size > max_bytes:
+                    # always return at least one file, the client asks again for the remaining ones
+                    remaining = uuids[i:]
+                    break
+                contents[uuid] = f.read()
+                check_hash(uuid, f, contents[uuid])
+        except FileNotFoundError:
+            missing.append(uuid)
+        else:
+            total_bytes += file_size
+
+    return {
+        'contents': contents,
+        'missing': missing,
+        'remaining': remaining,
+    }
+
+
+@ctx_request.route(IDENTITY + '/hashes', methods=['GET'], parameters=['uuids'])
+def retrieve_hashes(request):
+    # only stored hashes are returned, fragments that are not hashed yet are pending
+    uuids = request.parameters['uuids']
+    max_seconds = request.parameters.get('max_seconds', BATCH_MAX_SECONDS)
+
+    hashes = {}
+    pending = []
+    remaining = []
+    deadline = time.monotonic() + max_seconds
+    for i, uuid in enumerate(uuids):
+        if i > 0 and time.monotonic() > deadline:
+            # the client asks again for the remaining ones
+            remaining = uuids[i:]
+            break
+        try:
+            file_hash = read_hash(uuid)
+        except FileNotFoundError:
+            hashes[uuid] = ''
+        else:
+            if file_hash is None:
+                pending.append(uuid)
+            else:
+                hashes[uuid] = file_hash
+
+    return {
+        'hashes': hashes,
+        'pending': pending,
+        'remaining': remaining,
+    }
+
+
+@ctx_request.route(IDENTITY + '/files', methods=['DELETE'], parameters=['uuids'])
+def delete_files(request):
+    uuids = request.parameters['uuids']
+    for uuid in uuids:
+        remove_fragment(uuid)
+
+    return {
+        'uuids': uuids,
+        'available_bytes': get_available_bytes(),
+    }
+
+
 @ctx_request.route(IDENTITY + '/stats', methods=['GET'])
 def retrieve_stats(request):
     return {
@@ -171,6 +505,8 @@ def run():
             message_public_keys=config.get('security', 'message_public_keys'),
         ))
 
+    get_stored_bytes()
+    threading.Thread(target=store_missing_hashes, daemon=True).start()
     worker.run()
 
 
@@ -40,3 +40,32 @@ if not response.status_code == requests.codes.ok:
 end = time.perf_counter()
 
 print('elapsed time: {} s'.format(round(end - start, 3)))
+
+print('Read file in parts')
+start = time.perf_counter()
+part_size = 1024 * 1024
+content = b''
+while True:
+    response = get_client().get(
+        'file',
+        parameters={'source': hub.cumulus_id,
+                    'collection': 'nextcloud',
+                    'name': filename,
+                    'offset': len(content),
+                    'length': part_size},
+        decode_response=False
+    )
+    if not response.status_code == requests.codes.ok:
+        print('Error in storage/retrieval (request)')
+        break
+    part = response.response[b'content']
+    content += part
+    if len(part) < part_size:
+        break
+
+if content != file_content:
+    print('Error in storage/retrieval (content)')
+
+end = time.perf_counter()
+
+print('elapsed time: {} s'.format(round(end - start, 3)))
@@ -0,0 +1,56 @@
+import os
+import time
+
+import requests
+
+from app.models.hub import Hub
+from nimbus import config
+from nimbus.client import Client
+
+filename = 'learningreact1.pdf'
+with open(os.path.join('tmp', filename), 'rb') as f:
+    file_content = f.read()
+
+CONNECT_URL = 'tcp://{}:{}'.format(config.get('proxy-requests', 'client_hostname'),
+                                   config.get('proxy-requests', 'client_port'))
+
+
+def get_client():
+    return Client(connect=CONNECT_URL, timeout=120)
+
+
+hub = Hub.objects.first()
+
+start = time.perf_counter()
+
+print('Source: {}'.format(hub.cumulus_id))
+
+print('Store file in parts')
+part_size = 1024 * 1024
+upload = get_client().post(
+    'upload',
+    parameters={'source': hub.cumulus_id,
+                'collection': 'nextcloud',
+                'name': filename}
+).response
+
+while upload['size'] < len(file_content):
+    response = get_client().post(
+        'upload/part',
+        parameters={'upload': upload['upload'],
+                    'offset': upload['size']},
+        data=file_content[upload['size']:upload['size'] + part_size]
+    )
+    if not response.status_code == requests.codes.ok:
+        # continue where the proxy worker stopped receiving
+        upload = get_client().get('upload', parameters={'upload': upload['upload']}).response
+    else:
+        upload = response.response
+
+response = get_client().post('upload/complete', parameters={'upload': upload['upload']})
+if not response.status_code == requests.codes.ok:
+    print('Error in storage (request)')
+
+end = time.perf_counter()
+
+print('elapsed time: {} s'.format(round(end - start, 3)))
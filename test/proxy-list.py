@@ -17,3 +17,15 @@ pprint(response)
 
 response = client.list('file', parameters={'source': 'non-existing-id'}).response
 pprint(response)
+
+# page through all files of the source, 2 at a time
+cursor = None
+while True:
+    parameters = {'source': source, 'limit': 2}
+    if cursor is not None:
+        parameters['cursor'] = cursor
+    page = client.list('file', parameters=parameters).response
+    if not page:
+        break
+    pprint(page)
+    cursor = page[-1]['uuid']
@@ -0,0 +1,45 @@
+import os
+import uuid
+
+from app.helpers import one
+from app.models.file import File, Encoding
+from app.models.hub import Hub
+from app.models.reconstruction import ReconstructionTask
+from app.tasks.verify import v_all_hashes
+
+filename = 'fluentpython.pdf'
+with open(os.path.join('tmp', filename), 'rb') as f:
+    file_content = f.read()
+
+hub = Hub.objects.first()
+if hub is None:
+    hub = Hub(reference='HUB-' + uuid.uuid4().hex)
+    hub.save()
+
+file = File()
+file.source = hub
+file.collection = 'verify'
+file.filename = uuid.uuid4().hex + '-' + filename
+file.encoding = Encoding(name='liberasurecode_rs_vand', k=2, m=3, stripe_size=64 * 1024)
+
+with file as f:
+    f.write(file_content)
+
+print('Mark one fragment unclean, like a read of corrupt content does')
+fragment = file.fragments[0]
+fragment.is_clean = False
+file.save()
+ReconstructionTask.objects(file=file.uuid).delete()
+
+print('Verify the hashes of all files, the stored hash of the fragment still matches')
+v_all_hashes()
+
+file.reload()
+if one(file.fragments.filter(uuid=fragment.uuid)).is_clean:
+    print('Error: the unclean fragment is clean again')
+
+if ReconstructionTask.objects(file=file.uuid).count() != 1:
+    print('Error: the file is not queued for reconstruction')
+
+file.remove()
+ReconstructionTask.objects(file=file.uuid).delete()